@@ -1,19 +1,117 @@
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Engine, Connection
+import pandas as pd
+import io
+import csv
+from typing import Iterable
+
+
+# Postgres types of the COLUMN_TYPES dtypes, for tables created by the bulk loader
+POSTGRES_COLUMN_TYPES = {"string": "text", "category": "text", str: "text",
+                         "Int64": "bigint", int: "bigint",
+                         float: "double precision",
+                         "datetime64[ns]": "timestamp"}
+# Rows serialized per COPY round trip
+COPY_CHUNKSIZE = 100000
+COPY_NULL = "\\N"
 
 def connect_to_db(db_url: str) -> Engine:
     mydb = create_engine(db_url)
     return mydb
 
 def execute_sql_from_file(file: str, db: Engine):
-    with db.connect() as conn:
+    # Committed explicitly, autocommit does not detect scripts starting with a comment
+    with db.begin() as conn:
         with open(file) as f:
             query = text(f.read())
             conn.execute(query)
 
 def execute_sql_query(query: str, db: Engine):
-    with db.connect() as conn:
+    with db.begin() as conn:
         conn.execute(text(query))
         
 def disconnect_db(db: Engine):
-    db.dispose()
\ No newline at end of file
+    db.dispose()
+
+def copy_values_to_temp_table(values: list, table_name: str, column_name: str, conn: Connection):
+    # Upload distinct values into a temporary table of the connection session with COPY
+    conn.execute(text(f"CREATE TEMP TABLE IF NOT EXISTS {table_name} ({column_name} text PRIMARY KEY);"))
+    conn.execute(text(f"TRUNCATE {table_name};"))
+    
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows([value] for value in values)
+    buffer.seek(0)
+    
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table_name} ({column_name}) FROM STDIN WITH (FORMAT csv)", buffer)
+    conn.execute(text(f"ANALYZE {table_name};"))
+
+def stream_sql_query(query: str, conn: Connection, chunksize: int):
+    # Stream the result through a server-side cursor, in data frames of chunksize rows
+    return pd.read_sql(text(query), conn.execution_options(stream_results=True), chunksize=chunksize)
+
+def create_table_from_column_types(table_name: str, db_schema: str, column_types: dict, conn: Connection):
+    columns = ", ".join(f"{column_name} {POSTGRES_COLUMN_TYPES[column_type]}" for column_name, column_type in column_types.items())
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {db_schema}.{table_name} ({columns});"))
+
+def copy_frame(df: pd.DataFrame, table_name: str, conn: Connection):
+    # Serialize to csv in slices of COPY_CHUNKSIZE rows so the buffer stays small, NULLs are written as COPY_NULL
+    columns = ", ".join(df.columns)
+    with conn.connection.cursor() as cursor:
+        for start in range(0, df.shape[0], COPY_CHUNKSIZE):
+            buffer = io.StringIO()
+            df.iloc[start:start + COPY_CHUNKSIZE].to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer)
+
+def upsert_query(table_name: str, staging_table_name: str, columns: list, conflict_columns: list=None, update: bool=True) -> str:
+    insert_query = f"INSERT INTO {table_name} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {staging_table_name}"
+    if not conflict_columns:
+        return insert_query + ";"
+
+    update_columns = [column for column in columns if column not in conflict_columns]
+    if update and update_columns:
+        return insert_query + f" ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET {', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns)};"
+    return insert_query + f" ON CONFLICT ({', '.join(conflict_columns)}) DO NOTHING;"
+
+def copy_to_table(data: pd.DataFrame|Iterable[pd.DataFrame], table_name: str, db_schema: str, column_types: dict, db: Engine|Connection,
+                  if_exists: str="append", staging: bool=False, conflict_columns: list=None, update: bool=True) -> int:
+    # Bulk load a data frame or an iterator of data frames with COPY FROM STDIN, in one transaction.
+    # The table is created from column_types when missing. With staging, each data frame is copied into a
+    # temp table of the session (unlogged and private to this writer) and moved into the table with one
+    # INSERT ... SELECT. With conflict_columns, data frames are deduplicated on them and upserted against
+    # the unique index on those columns: the other columns are updated, or the rows skipped if not update
+    if if_exists not in ["append", "replace"]: raise ValueError("if_exists can only be 'append' or 'replace'")
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    if isinstance(db, Engine):
+        with db.begin() as conn:
+            return copy_to_table(data, table_name, db_schema, column_types, conn, if_exists, staging, conflict_columns, update)
+
+    conn = db
+    if if_exists == "replace":
+        conn.execute(text(f"DROP TABLE IF EXISTS {db_schema}.{table_name};"))
+    create_table_from_column_types(table_name, db_schema, column_types, conn)
+
+    staging = staging or bool(conflict_columns)
+    if staging:
+        staging_table_name = f"{table_name}_staging"
+        conn.execute(text(f"CREATE TEMP TABLE IF NOT EXISTS {staging_table_name} (LIKE {db_schema}.{table_name});"))
+        conn.execute(text(f"TRUNCATE {staging_table_name};"))
+
+    nRows = 0
+    for df in data:
+        if df.empty: continue
+        if conflict_columns:
+            df = df.drop_duplicates(subset=conflict_columns, keep='last')
+
+        if staging:
+            copy_frame(df, staging_table_name, conn)
+            conn.execute(text(upsert_query(f"{db_schema}.{table_name}", staging_table_name, list(df.columns), conflict_columns, update)))
+            conn.execute(text(f"TRUNCATE {staging_table_name};"))
+        else:
+            copy_frame(df, f"{db_schema}.{table_name}", conn)
+        nRows += df.shape[0]
+
+    return nRows
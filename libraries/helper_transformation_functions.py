@@ -23,4 +23,71 @@ def standardardize_column(df, column_name, patterns, isregex=True) -> pd.DataFra
         df[f'{column_name}'] = df[f'{column_name}'].replace(regex=patterns)
     else:
         df[f'{column_name}'] = df[f'{column_name}'].replace(patterns)
-    return df
\ No newline at end of file
+    return df
+def normalize_column_types(df, column_types, nan_patterns, datetime_formats=None) -> pd.DataFrame:
+    # One pass per column driven by its target dtype: nan patterns are only looked up in string columns
+    # and in columns the parser could not type, datetimes are parsed with their known format
+    datetime_formats = datetime_formats or {}
+    columns = {}
+    for column_name, column in df.items():
+        column_type = column_types.get(column_name)
+
+        if column_type is None:
+            columns[column_name] = column
+        elif column_type == "category":
+            # Patterns are looked up in the distinct values only
+            column = column.astype("category")
+            columns[column_name] = column.cat.remove_categories(column.cat.categories[column.cat.categories.isin(nan_patterns)])
+        elif column_type == "string":
+            column = column.astype("string")
+            columns[column_name] = column.mask(column.isin(nan_patterns))
+        else:
+            if column.dtype == object:
+                column = column.mask(column.isin(nan_patterns))
+
+            if str(column_type).startswith("datetime64"):
+                try:
+                    columns[column_name] = pd.to_datetime(column, format=datetime_formats.get(column_name), cache=True)
+                except ValueError:
+                    columns[column_name] = pd.to_datetime(column, cache=True)
+            else:
+                if column.dtype == object and pd.api.types.is_integer_dtype(column_type):
+                    column = pd.to_numeric(column)
+                columns[column_name] = column.astype(column_type)
+
+    # Build the frame once rather than setting columns one by one
+    return pd.DataFrame(columns, index=df.index)
+
+def standardardize_category(df, column_name, patterns={}, lowercase=False) -> pd.DataFrame:
+    # Standardize the distinct values of a categorical column only, values standardized alike are merged
+    column = df[column_name]
+    # All null (e.g. a page without any floor level): nothing to standardize
+    if column.cat.categories.empty:
+        return df
+
+    categories = pd.Series(column.cat.categories)
+    if lowercase:
+        categories = categories.str.lower()
+    categories = categories.replace(patterns)
+
+    new_categories = pd.Index(categories.unique())
+    codes = new_categories.get_indexer(categories)
+    # np.where evaluates both branches, null codes (-1) are clipped before indexing
+    old_codes = column.cat.codes.values
+    new_codes = np.where(old_codes >= 0, codes[np.maximum(old_codes, 0)], -1)
+    df[column_name] = pd.Categorical.from_codes(new_codes, categories=new_categories)
+    return df
+
+def concat_frames(frames, ignore_index=True) -> pd.DataFrame:
+    # pd.concat falls back to object for categoricals with different categories, align their categories first
+    if not frames: return pd.DataFrame()
+
+    for column_name in frames[0].columns:
+        if all(isinstance(frame[column_name].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = frames[0][column_name].cat.categories
+            for frame in frames[1:]:
+                categories = categories.union(frame[column_name].cat.categories)
+            for frame in frames:
+                frame[column_name] = frame[column_name].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=ignore_index)
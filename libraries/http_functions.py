@@ -0,0 +1,116 @@
+import requests
+import threading
+import time
+import logging
+import hashlib
+import json
+import os
+
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class TokenBucket:
+    # Rate limiter shared by threads: one token per request, refilled at rate tokens per second
+    def __init__(self, rate: float, capacity: int=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_with_retry(url: str, headers: dict=None, session: requests.Session=None, rate_limiter: TokenBucket=None,
+                   max_retries: int=5, backoff_seconds: float=1.0, timeout: float=60) -> requests.Response:
+    # GET with exponential backoff on rate limiting, server errors and connection errors
+    session = session or requests
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries: raise
+            logging.warning(f"Request failed ({e}), retrying: {url}")
+            time.sleep(backoff_seconds * 2 ** attempt)
+            continue
+
+        if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+            return response
+
+        # Wait as asked by the server if it says so
+        retry_after = response.headers.get("Retry-After", "")
+        wait = float(retry_after) if retry_after.isdigit() else backoff_seconds * 2 ** attempt
+        logging.warning(f"Request returned status code {response.status_code}, retrying in {wait} seconds: {url}")
+        time.sleep(wait)
+
+def load_download_manifest(manifest_path: str) -> dict:
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def record_download(url: str, download: dict, manifest_path: str):
+    # Called once the downloaded file has been loaded, so that a failed load is downloaded again by the next run
+    manifest = load_download_manifest(manifest_path)
+    manifest[url] = download
+
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+def download_if_changed(url: str, file_path: str, manifest_path: str, session: requests.Session=None,
+                        chunk_size: int=1024 * 1024, timeout: float=60) -> dict:
+    # Conditional GET with the ETag and Last-Modified recorded by the previous download, streamed to file_path
+    # and hashed on the way. Returns None when the source did not change: 304 or same size and hash as recorded,
+    # otherwise the manifest entry to record once the file has been loaded
+    session = session or requests
+    previous_download = load_download_manifest(manifest_path).get(url, {})
+    headers = {}
+    if previous_download.get("etag"):
+        headers["If-None-Match"] = previous_download["etag"]
+    if previous_download.get("last_modified"):
+        headers["If-Modified-Since"] = previous_download["last_modified"]
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            logging.info(f"Source not modified since the last download: {url}")
+            return None
+        response.raise_for_status()
+
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        content_hash = hashlib.sha256()
+        size = 0
+        with open(file_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                content_hash.update(chunk)
+                size += len(chunk)
+
+        download = {"etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "size": size,
+                    "sha256": content_hash.hexdigest()}
+
+    if previous_download.get("size") == download["size"] and previous_download.get("sha256") == download["sha256"]:
+        # Same content as loaded already, the new validators are recorded so that the next request gets a 304
+        logging.info(f"Source content unchanged since the last download: {url}")
+        os.remove(file_path)
+        record_download(url, download, manifest_path)
+        return None
+
+    return download
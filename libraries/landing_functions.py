@@ -0,0 +1,45 @@
+import pandas as pd
+import logging
+import glob
+import os
+import shutil
+from typing import Iterator
+
+
+# Raw pulls as they came from the source, one directory per source, year and month: <path>/<source>/year=YYYY/month=MM/part-NNNNN.parquet
+def get_partition_path(landing_path: str, source: str, year: int, month: int) -> str:
+    return os.path.join(landing_path, source, f"year={int(year)}", f"month={int(month):02d}")
+
+def clear_partition(landing_path: str, source: str, year: int, month: int):
+    # A new pull of a partition replaces all parts of the previous one
+    shutil.rmtree(get_partition_path(landing_path, source, year, month), ignore_errors=True)
+
+def write_partition(df: pd.DataFrame, landing_path: str, source: str, year: int, month: int, part: int=0, compression: str="zstd") -> str:
+    partition_path = get_partition_path(landing_path, source, year, month)
+    os.makedirs(partition_path, exist_ok=True)
+
+    # Parquet needs string column names, csv read without header has positions
+    file_path = os.path.join(partition_path, f"part-{part:05d}.parquet")
+    df.rename(columns=str).to_parquet(file_path, engine="pyarrow", compression=compression, index=False)
+
+    return file_path
+
+def get_partitions(landing_path: str, source: str, from_year: int=None, to_year: int=None) -> list[tuple[int, int]]:
+    # Landed (year, month) of a source in order, optionally within a year range
+    partitions = []
+    for partition_path in glob.glob(os.path.join(landing_path, source, "year=*", "month=*")):
+        year = int(os.path.basename(os.path.dirname(partition_path)).split("=")[1])
+        month = int(os.path.basename(partition_path).split("=")[1])
+        if (from_year is None or year >= int(from_year)) and (to_year is None or year <= int(to_year)):
+            partitions.append((year, month))
+
+    return sorted(partitions)
+
+def read_partition(landing_path: str, source: str, year: int, month: int) -> Iterator[pd.DataFrame]:
+    # Parts are read one by one as they were pulled, their schemas can differ (e.g. json and csv pages)
+    file_paths = sorted(glob.glob(os.path.join(get_partition_path(landing_path, source, year, month), "part-*.parquet")))
+    if not file_paths:
+        logging.warning(f"No landed data for {source} {month:02d}-{year}.")
+
+    for file_path in file_paths:
+        yield pd.read_parquet(file_path, engine="pyarrow")
@@ -18,24 +18,29 @@ EPC_API_CREDENTIALS = str(os.getenv("UK_EPC_API_AUTHENTICATION_TOKEN"))
 EPC_MIN_YEAR = 2008
 EPC_MIN_MONTH = 10
 
+# Raw pulls are persisted as parquet partitioned by source, year and month when enabled, to be replayed without network
+LANDING_ZONE = {"path": os.getenv("LANDING_ZONE_PATH", "landing"),
+                "enabled": os.getenv("LANDING_ZONE_ENABLED", "false").lower() == "true",
+                "compression": "zstd"}
+
 COLUMN_TYPES = {"residential_energy_performance_certificate": {"lmk_key": "string",
                                                         "address1": "string",
                                                         "address2": "string",
                                                         "address3": "string",
                                                         "postcode": "string",
                                                         "building_reference_number": "string",
-                                                        "current_energy_rating": "string",
-                                                        "potential_energy_rating": "string",
+                                                        "current_energy_rating": "category",
+                                                        "potential_energy_rating": "category",
                                                         "current_energy_efficiency": float,
                                                         "potential_energy_efficiency": float,
-                                                        "property_type": "string",
-                                                        "built_form": "string",
+                                                        "property_type": "category",
+                                                        "built_form": "category",
                                                         "inspection_date": "datetime64[ns]",
-                                                        "local_authority": "string",
-                                                        "constituency": "string",
-                                                        "county": "string",
+                                                        "local_authority": "category",
+                                                        "constituency": "category",
+                                                        "county": "category",
                                                         "lodgement_date": "datetime64[ns]",
-                                                        "transaction_type": "string",
+                                                        "transaction_type": "category",
                                                         "environment_impact_current": float,
                                                         "environment_impact_potential": float,
                                                         "energy_consumption_current": float,
@@ -50,67 +55,105 @@ COLUMN_TYPES = {"residential_energy_performance_certificate": {"lmk_key": "strin
                                                         "hot_water_cost_current": float,
                                                         "hot_water_cost_potential": float,
                                                         "total_floor_area": float,
-                                                        "energy_tariff": "string",
-                                                        "mains_gas_flag": "string",
-                                                        "floor_level": "string",
-                                                        "flat_top_storey": "string",
+                                                        "energy_tariff": "category",
+                                                        "mains_gas_flag": "category",
+                                                        "floor_level": "category",
+                                                        "flat_top_storey": "category",
                                                         "flat_storey_count": float,
                                                         "main_heating_controls": float,
                                                         "multi_glaze_proportion": float,
-                                                        "glazed_type": "string",
-                                                        "glazed_area": "string",
+                                                        "glazed_type": "category",
+                                                        "glazed_area": "category",
                                                         "extension_count": float,
                                                         "number_habitable_rooms": float,
                                                         "number_heated_rooms": float,
                                                         "low_energy_lighting": float,
                                                         "number_open_fireplaces": float,
-                                                        "hotwater_description": "string",
-                                                        "hot_water_energy_eff": "string",
-                                                        "hot_water_env_eff": "string",
-                                                        "floor_description": "string",
-                                                        "floor_energy_eff": "string",
-                                                        "floor_env_eff": "string",
-                                                        "windows_description": "string",
-                                                        "windows_energy_eff": "string",
-                                                        "windows_env_eff": "string",
-                                                        "walls_description": "string",
-                                                        "walls_energy_eff": "string",
-                                                        "walls_env_eff": "string",
-                                                        "secondheat_description": "string",
-                                                        "sheating_energy_eff": "string",
-                                                        "sheating_env_eff": "string",
-                                                        "roof_description": "string",
-                                                        "roof_energy_eff": "string",
-                                                        "roof_env_eff": "string",
-                                                        "mainheat_description": "string",
-                                                        "mainheat_energy_eff": "string",
-                                                        "mainheat_env_eff": "string",
-                                                        "mainheatcont_description": "string",
-                                                        "mainheatc_energy_eff": "string",
-                                                        "mainheatc_env_eff": "string",
-                                                        "lighting_description": "string",
-                                                        "lighting_energy_eff": "string",
-                                                        "lighting_env_eff": "string",
-                                                        "main_fuel": "string",
+                                                        "hotwater_description": "category",
+                                                        "hot_water_energy_eff": "category",
+                                                        "hot_water_env_eff": "category",
+                                                        "floor_description": "category",
+                                                        "floor_energy_eff": "category",
+                                                        "floor_env_eff": "category",
+                                                        "windows_description": "category",
+                                                        "windows_energy_eff": "category",
+                                                        "windows_env_eff": "category",
+                                                        "walls_description": "category",
+                                                        "walls_energy_eff": "category",
+                                                        "walls_env_eff": "category",
+                                                        "secondheat_description": "category",
+                                                        "sheating_energy_eff": "category",
+                                                        "sheating_env_eff": "category",
+                                                        "roof_description": "category",
+                                                        "roof_energy_eff": "category",
+                                                        "roof_env_eff": "category",
+                                                        "mainheat_description": "category",
+                                                        "mainheat_energy_eff": "category",
+                                                        "mainheat_env_eff": "category",
+                                                        "mainheatcont_description": "category",
+                                                        "mainheatc_energy_eff": "category",
+                                                        "mainheatc_env_eff": "category",
+                                                        "lighting_description": "category",
+                                                        "lighting_energy_eff": "category",
+                                                        "lighting_env_eff": "category",
+                                                        "main_fuel": "category",
                                                         "wind_turbine_count": float,
-                                                        "heat_loss_corridor": "string",
+                                                        "heat_loss_corridor": "category",
                                                         "unheated_corridor_length": float,
                                                         "floor_height": float,
                                                         "photo_supply": float,
-                                                        "solar_water_heating_flag": "string",
-                                                        "mechanical_ventilation": "string",
+                                                        "solar_water_heating_flag": "category",
+                                                        "mechanical_ventilation": "category",
                                                         "address": "string",
-                                                        "local_authority_label": "string",
-                                                        "constituency_label": "string",
-                                                        "posttown": "string",
-                                                        "construction_age_band": "string",
+                                                        "local_authority_label": "category",
+                                                        "constituency_label": "category",
+                                                        "posttown": "category",
+                                                        "construction_age_band": "category",
                                                         "lodgement_datetime": "datetime64[ns]",
-                                                        "tenure": "string",
+                                                        "tenure": "category",
                                                         "fixed_lighting_outlets_count": float,
                                                         "low_energy_fixed_light_count": float,
-                                                        "uprn": "string",
-                                                        "uprn_source": "string"
-                                                        }
+                                                        "uprn": "Int64",
+                                                        "uprn_source": "category"
+                                                        },
+                
+                # Normalized address keys of the linkage rules, computed once when certificates are loaded
+                "residential_epc_linkage_keys": {"lmk_key": "string",
+                                                 "postcode": "string",
+                                                 "add1": "string",
+                                                 "add2": "string",
+                                                 "property_type": "string",
+                                                 "address_final1": "string",
+                                                 "address_final2": "string",
+                                                 "address_final3": "string",
+                                                 "address_final4": "string",
+                                                 "address_final5": "string",
+                                                 "address_final6": "string",
+                                                 "address_final7": "string",
+                                                 "address_final8": "string",
+                                                 "address_final9": "string",
+                                                 "address_final10": "string",
+                                                 "address_final11": "string",
+                                                 "address_final13": "string",
+                                                 "address_final14": "string",
+                                                 "address_final15": "string",
+                                                 "address_final16": "string",
+                                                 "address_final17": "string",
+                                                 "address_final19": "string",
+                                                 "address_final20": "string",
+                                                 "address_final24": "string",
+                                                 "address_final27": "string",
+                                                 "address_final29": "string",
+                                                 "address_final32": "string",
+                                                 "address_final33": "string",
+                                                 "address_final35": "string",
+                                                 "address_final37": "string",
+                                                 "address_final38": "string",
+                                                 "add1_4": "string",
+                                                 "add1_5": "string",
+                                                 "add1_comma_sep2_1": "string",
+                                                 "add1_firstword__add2": "string"
+                                                 }
                 }
 
 EPC_LOCAL_AUTHORITIES = {"Adur": "E07000223",
@@ -459,57 +502,83 @@ EPC_LOCAL_AUTHORITIES = {"Adur": "E07000223",
 
 NAN_PATTERNS = ["N/A", "NaN", "nan", "unknown", "UNKNOWN", "Unknown", "INVALID!", "NODATA!", "NO DATA!", ""]
 REDUNDANT_PATTERNS = ["%%MAINHEATCONTROL%%"]
-FLOOR_LEVEL_PATTERNS = {r'^ground floor$': 'ground',
-                        r'^mid floor$': 'mid',
-                        r'^top floor$': 'top',
-                        r'^\-1$': 'basement',
-                        r'^0$': 'ground',
-                        r'^00$': 'ground',
-                        r'^1$': '1st',
-                        r'^01$': '1st',
-                        r'^2$': '2nd',
-                        r'^02$': '2nd',
-                        r'^3$': '3rd',
-                        r'^03$': '3rd',
-                        r'^4$': '4th',
-                        r'^04$': '4th',
-                        r'^5$': '5th',
-                        r'^05$': '5th',
-                        r'^6$': '6th',
-                        r'^06$': '6th',
-                        r'^7$': '7th',
-                        r'^07$': '7th',
-                        r'^8$': '8th',
-                        r'^08$': '8th',
-                        r'^9$': '9th',
-                        r'^09$': '9th',
-                        r'^10$': '10th',
-                        r'^11$': '11th',
-                        r'^12$': '12th',
-                        r'^13$': '13th',
-                        r'^14$': '14th',
-                        r'^15$': '15th',
-                        r'^16$': '16th',
-                        r'^17$': '17th',
-                        r'^18$': '18th',
-                        r'^19$': '19th',
-                        r'^20$': '20th',
-                        r'^20\+$': '21st or above'
-                        }
+DATETIME_FORMATS = {"inspection_date": "%Y-%m-%d", "lodgement_date": "%Y-%m-%d", "lodgement_datetime": "%Y-%m-%d %H:%M:%S"}
+FLOOR_LEVEL_VALUES = {'ground floor': 'ground',
+                      'mid floor': 'mid',
+                      'top floor': 'top',
+                      '-1': 'basement',
+                      '0': 'ground',
+                      '00': 'ground',
+                      '1': '1st',
+                      '01': '1st',
+                      '2': '2nd',
+                      '02': '2nd',
+                      '3': '3rd',
+                      '03': '3rd',
+                      '4': '4th',
+                      '04': '4th',
+                      '5': '5th',
+                      '05': '5th',
+                      '6': '6th',
+                      '06': '6th',
+                      '7': '7th',
+                      '07': '7th',
+                      '8': '8th',
+                      '08': '8th',
+                      '9': '9th',
+                      '09': '9th',
+                      '10': '10th',
+                      '11': '11th',
+                      '12': '12th',
+                      '13': '13th',
+                      '14': '14th',
+                      '15': '15th',
+                      '16': '16th',
+                      '17': '17th',
+                      '18': '18th',
+                      '19': '19th',
+                      '20': '20th',
+                      '20+': '21st or above'
+                      }
 
-# OUTPUT_DATA -> platform -> output_table_name -> bucket, country, subject, source, table_name, path_date_params, file_extension, column_types
+# OUTPUT_DATA -> platform -> output_table_name -> bucket, country, subject, source, table_name, path_date_params, file_extension, column_types, unique_columns
 OUTPUT_DATA =  {"DB": {"residential_energy_performance_certificate": {"table_name": "residential_energy_performance_certificate",
                                                             "db_schema": "linked_ppd_epc",
-                                                            "column_types": COLUMN_TYPES["residential_energy_performance_certificate"]
-                                                            }
+                                                            "column_types": COLUMN_TYPES["residential_energy_performance_certificate"],
+                                                            "unique_columns": ["lmk_key"]
+                                                            },
+                       
+                       "residential_epc_linkage_keys": {"table_name": "residential_epc_linkage_keys",
+                                                        "db_schema": "linked_ppd_epc",
+                                                        "column_types": COLUMN_TYPES["residential_epc_linkage_keys"],
+                                                        "unique_columns": ["lmk_key"]
+                                                        }
                       }
                 }
 
 # INPUT_DATA -> platform -> output_table_name -> platform-specific configs
 INPUT_DATA =  {"SOURCE": {"residential_energy_performance_certificate":  {"endpoint_url": "https://epc.opendatacommunities.org/api/v1/domestic/search?",
-                                                                  "endpoint_headers": {"Accept": "application/json", "Authorization": EPC_API_CREDENTIALS},
+                                                                  "endpoint_headers": {"Accept": "text/csv", "Authorization": EPC_API_CREDENTIALS},
                                                                   "api_max_read_size": 5000,
-                                                                  "api_max_read_total": 10000
+                                                                  "api_max_read_total": 10000,
+                                                                  "api_cursor_header": "X-Next-Search-After",
+                                                                  "api_split_characters": "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ",
+                                                                  "api_max_concurrency": int(os.getenv("EPC_API_MAX_CONCURRENCY", 8)),
+                                                                  "api_max_requests_per_second": float(os.getenv("EPC_API_MAX_REQUESTS_PER_SECOND", 10)),
+                                                                  "api_max_retries": 5,
+                                                                  "api_backoff_seconds": 1
                                                                   }
-                           }
-               }
\ No newline at end of file
+                           },
+               
+               "ARCHIVE": {"residential_energy_performance_certificate": {"member_file_name": "certificates.csv",
+                                                                           "chunksize": 100000,
+                                                                           "max_workers": int(os.getenv("EPC_ARCHIVE_MAX_WORKERS", 4))
+                                                                           }
+                           },
+               
+               "DB": {"residential_energy_performance_certificate": OUTPUT_DATA["DB"]["residential_energy_performance_certificate"]
+                      }
+               }
+
+# Update params for INPUT_DATA
+INPUT_DATA["DB"]["residential_energy_performance_certificate"]["needed_columns"] = ["lmk_key", "address1", "address2", "address3", "postcode", "property_type", "address"]
\ No newline at end of file
@@ -4,80 +4,179 @@ from .config import *
 # Import custom modules
 from libraries import db_functions as db_func
 from libraries import helper_transformation_functions as helper_transform
+from libraries import http_functions as http_func
+from libraries import landing_functions as landing_func
+from . import transformer_epc_linkage_keys as linkage_keys
+from pipelines.UK_PPD import dirty_postcode_functions as dirty_func
 
 # Import py libs
 import pandas as pd
 import numpy as np
 import logging
 import requests
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 
 # Define global variables
 OUTPUT_TABLE_NAME = "residential_energy_performance_certificate"
 PIPELINE_INPUT = INPUT_DATA["SOURCE"][OUTPUT_TABLE_NAME]
 PIPELINE_OUTPUT = OUTPUT_DATA["DB"][OUTPUT_TABLE_NAME]
+LANDING_SOURCE = "epc"
 
 
 # Pipeline's helper functions
-def get_epc_from_api_by_year_month(from_year: str|int, from_month: str|int, to_year: str|int, to_month: str|int) -> pd.DataFrame:
-    # API by local authority as a workaround of pagination
-    epc_y_m = pd.DataFrame()
-    for local_code in EPC_LOCAL_AUTHORITIES.values():
-        df_local = pd.DataFrame()
-        to_continue = True
-        nRows = 0
-        nRowsLocal = 0
-        while to_continue and nRowsLocal < PIPELINE_INPUT['api_max_read_total']:
-            api_url = f"{PIPELINE_INPUT[f'endpoint_url']}from-year={from_year}&from-month={from_month}&to-year={to_year}&to-month={to_month}&local-authority={local_code}&size={PIPELINE_INPUT['api_max_read_size']}&from={nRowsLocal}"
+def get_epc_csv_column_types(columns: list) -> dict:
+    # C parser dtypes of the string and categorical columns of an epc csv, the parser infers the numeric ones
+    column_types = PIPELINE_OUTPUT["column_types"]
+    csv_column_types = {"string": str, "category": "category"}
+    return {column: csv_column_types[column_types[column.lower().replace('-', '_')]] for column in columns
+            if column_types.get(column.lower().replace('-', '_')) in csv_column_types}
+
+def parse_epc_page(content: bytes) -> pd.DataFrame:
+    # Csv pages go straight to the C parser, json pages (if csv is not served) are built from the records at once
+    if not content.strip():
+        raise ValueError("Empty page")
+    
+    if content.lstrip()[:1] == b"{":
+        content = json.loads(content)
+        return pd.DataFrame.from_records(content['rows'], columns=content['column-names'])
+    
+    columns = pd.read_csv(io.BytesIO(content), nrows=0).columns
+    return pd.read_csv(io.BytesIO(content), dtype=get_epc_csv_column_types(columns))
+
+def split_epc_window(from_year: int, from_month: int, to_year: int, to_month: int, postcode_prefix: str) -> list[tuple]:
+    # Split a saturated window by month if it covers several months, otherwise by the next postcode character
+    months = [(year, month) for year in range(from_year, to_year + 1) for month in range(1, 13)
+              if (from_year, from_month) <= (year, month) <= (to_year, to_month)]
+    if len(months) > 1:
+        return [(year, month, year, month, postcode_prefix) for year, month in months]
+
+    return [(from_year, from_month, to_year, to_month, postcode_prefix + character) for character in PIPELINE_INPUT['api_split_characters']]
+
+def get_epc_api_url(local_code: str, from_year: str|int, from_month: str|int, to_year: str|int, to_month: str|int,
+                    postcode_prefix: str="", size: int=PIPELINE_INPUT['api_max_read_size']) -> str:
+    api_url = f"{PIPELINE_INPUT[f'endpoint_url']}from-year={from_year}&from-month={from_month}&to-year={to_year}&to-month={to_month}&local-authority={local_code}&size={size}"
+    if postcode_prefix:
+        api_url += f"&postcode={postcode_prefix}"
+    return api_url
+
+def is_epc_window_saturated(local_code: str, from_year: str|int, from_month: str|int, to_year: str|int, to_month: str|int, postcode_prefix: str,
+                            session: requests.Session, rate_limiter: http_func.TokenBucket=None) -> bool:
+    # A record at the last offset means the window holds more records than offsets can reach
+    api_url = get_epc_api_url(local_code, from_year, from_month, to_year, to_month, postcode_prefix, size=1) + f"&from={PIPELINE_INPUT['api_max_read_total'] - 1}"
+    response = http_func.get_with_retry(api_url, headers=PIPELINE_INPUT['endpoint_headers'], session=session, rate_limiter=rate_limiter,
+                                        max_retries=PIPELINE_INPUT['api_max_retries'], backoff_seconds=PIPELINE_INPUT['api_backoff_seconds'])
+    if response.status_code != 200:
+        logging.error(f"API request failed with status code {response.status_code}: {api_url}")
+        return False
+
+    try:
+        return not parse_epc_page(response.content).empty
+    except ValueError:
+        return False
+
+def get_epc_from_api_by_local_authority(local_code: str, from_year: str|int, from_month: str|int, to_year: str|int, to_month: str|int,
+                                        rate_limiter: http_func.TokenBucket=None, postcode_prefix: str="") -> list[pd.DataFrame]:
+    # Page with the search-after cursor when the API sends one, otherwise with offsets up to api_max_read_total,
+    # splitting the window when it holds more records than offsets can reach. Pages are returned as they are,
+    # to be concatenated and deduplicated once
+    pages = []
+    to_continue = True
+    nRows = 0
+    nRowsLocal = 0
+    search_after = None
+    with requests.Session() as session:
+        while to_continue:
+            api_url = get_epc_api_url(local_code, from_year, from_month, to_year, to_month, postcode_prefix)
+            api_url += f"&search-after={search_after}" if search_after is not None else f"&from={nRowsLocal}"
+
+            response = http_func.get_with_retry(api_url, headers=PIPELINE_INPUT['endpoint_headers'], session=session, rate_limiter=rate_limiter,
+                                                max_retries=PIPELINE_INPUT['api_max_retries'], backoff_seconds=PIPELINE_INPUT['api_backoff_seconds'])
+            if response.status_code != 200:
+                # Retries exhausted, the error body is not a page
+                logging.error(f"API request failed with status code {response.status_code}: {api_url}")
+                break
+            search_after = response.headers.get(PIPELINE_INPUT['api_cursor_header'])
 
             try:
-                response = requests.get(api_url, headers=PIPELINE_INPUT['endpoint_headers'])
-                if response.status_code != 200:
-                    logging.error(f"API request failed with status code {response.status_code}")
-                response = response.json()
-                df_local_tmp = pd.DataFrame(response['rows'])
-                df_local_tmp = df_local_tmp[response['column-names']]
-                df_local = pd.concat([df_local, df_local_tmp], ignore_index=True)
-                df_local.drop_duplicates(inplace=True)
-                nRows = len(df_local_tmp)
-                to_continue = nRows == PIPELINE_INPUT['api_max_read_size']
-                nRowsLocal += nRows
+                df_local_tmp = parse_epc_page(response.content)
             except ValueError:
                 break
+            pages.append(df_local_tmp)
+            nRows = len(df_local_tmp)
+            to_continue = nRows == PIPELINE_INPUT['api_max_read_size']
+            nRowsLocal += nRows
 
-        epc_y_m = pd.concat([epc_y_m, df_local], ignore_index=True)
-        epc_y_m.drop_duplicates(inplace=True)
+            if to_continue and search_after is None:
+                if nRowsLocal >= PIPELINE_INPUT['api_max_read_total']:
+                    logging.error(f"Window {local_code} {from_month}-{from_year} postcode '{postcode_prefix}' cannot be split, records past {nRowsLocal} are skipped.")
+                    break
 
-    return epc_y_m
+                # Window saturated: decided after the first page, read it as smaller windows rather than paging further
+                if nRowsLocal == nRows and len(postcode_prefix) < 8 and \
+                   is_epc_window_saturated(local_code, from_year, from_month, to_year, to_month, postcode_prefix, session, rate_limiter):
+                    logging.info(f"Splitting saturated window {local_code} {from_month}-{from_year} to {to_month}-{to_year} postcode '{postcode_prefix}'.")
+                    windows = split_epc_window(int(from_year), int(from_month), int(to_year), int(to_month), postcode_prefix)
+                    pages = [page for window in windows for page in get_epc_from_api_by_local_authority(local_code, *window[:4], rate_limiter, window[4])]
+                    break
+
+    return pages
+
+def stream_epc_from_api_by_year_month(from_year: str|int, from_month: str|int, to_year: str|int, to_month: str|int,
+                                      max_workers: int=PIPELINE_INPUT['api_max_concurrency']) -> Iterator[pd.DataFrame]:
+    # API by local authority as a workaround of pagination, local authorities are requested
+    # concurrently under a shared rate limit and their pages yielded as they arrive
+    rate_limiter = http_func.TokenBucket(PIPELINE_INPUT['api_max_requests_per_second'], capacity=max_workers)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(get_epc_from_api_by_local_authority, local_code, from_year, from_month, to_year, to_month, rate_limiter)
+                   for local_code in EPC_LOCAL_AUTHORITIES.values()]
+        
+        for future in as_completed(futures):
+            for page in future.result():
+                if not page.empty:
+                    yield page
+
+def land_raw_epc_pages(pages: Iterator[pd.DataFrame], year: int, month: int) -> Iterator[pd.DataFrame]:
+    # Pages are landed as they arrive, one part each, and passed on untouched
+    landing_func.clear_partition(LANDING_ZONE["path"], LANDING_SOURCE, year, month)
+    for part, page in enumerate(pages):
+        landing_func.write_partition(page, LANDING_ZONE["path"], LANDING_SOURCE, year, month, part=part, compression=LANDING_ZONE["compression"])
+        yield page
 
 def normalize_raw_epc(epc: pd.DataFrame) -> pd.DataFrame:
     # Standardize column names
-    epc.columns = epc.columns.str.replace('-', '_', regex=False)
+    epc.columns = epc.columns.str.lower().str.replace('-', '_', regex=False)
     
-    # Standardize nan
-    epc = helper_transform.standardardize_nan(epc, NAN_PATTERNS, standard=np.nan)
-    epc = helper_transform.standardardize_nan(epc, REDUNDANT_PATTERNS, standard=np.nan)
-    
-    # Assign dtype
-    epc = epc.astype(PIPELINE_OUTPUT["column_types"])
-    epc = helper_transform.standardardize_nan(epc, NAN_PATTERNS, standard=np.nan)
+    # Standardize nan & assign dtype
+    epc = helper_transform.normalize_column_types(epc, PIPELINE_OUTPUT["column_types"], NAN_PATTERNS + REDUNDANT_PATTERNS, DATETIME_FORMATS)
     
     if OUTPUT_TABLE_NAME == "residential_energy_performance_certificate":
         # Standardize floor level
-        epc['floor_level'] = epc['floor_level'].str.lower()
-        epc = helper_transform.standardardize_column(epc, 'floor_level', FLOOR_LEVEL_PATTERNS, isregex=True)
+        epc = helper_transform.standardardize_category(epc, 'floor_level', FLOOR_LEVEL_VALUES, lowercase=True)
         
         # Standardize tenure
-        epc['tenure'] = epc['tenure'].str.lower()
+        epc = helper_transform.standardardize_category(epc, 'tenure', lowercase=True)
     
     # Drop duplicates
     epc.drop_duplicates(inplace=True)
     
     return epc
 
+def load_epc(epc: pd.DataFrame, mydb: Engine):
+    db_func.copy_to_table(epc, PIPELINE_OUTPUT["table_name"], PIPELINE_OUTPUT["db_schema"], PIPELINE_OUTPUT["column_types"], mydb, conflict_columns=PIPELINE_OUTPUT["unique_columns"])
+    
+    # Transform & Load: Compute linkage keys once, certificates never change once lodged
+    linkage_keys.load_epc_linkage_keys(epc, mydb)
+    dirty_func.mark_dirty_postcodes(epc['postcode'], "epc", mydb)
+
 
 # Pipeline's main functions
-def ETL_extract_epc(from_year: int=None, to_year: int=None):
+def ETL_extract_epc(from_year: int=None, to_year: int=None, max_workers: int=PIPELINE_INPUT['api_max_concurrency']):
     
     # Get current date
     current_date, current_month, current_year = helper_transform.get_current_datetime()
@@ -100,8 +199,13 @@ def ETL_extract_epc(from_year: int=None, to_year: int=None):
         
         logging.info(f"Started processing for {from_year} to {to_year}.")
 
+    max_workers = int(max_workers)
+
     # Connect to db
     mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_residential_energy_performance_certificate.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_residential_epc_linkage_keys.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_linkage_dirty_postcodes.sql", mydb)
 
     for year in range(from_year, to_year + 1):
 
@@ -123,27 +227,23 @@ def ETL_extract_epc(from_year: int=None, to_year: int=None):
 
         # Extract: API requests for monthly data
         for month in range(min_month, max_month + 1):
-            # Extract: API requests
-            epc_y_m = get_epc_from_api_by_year_month(from_year=year, from_month=month, to_year=year, to_month=month)
+            # Extract & Transform: API requests, each page normalized as it arrives
+            pages = stream_epc_from_api_by_year_month(year, month, year, month, max_workers)
+            if LANDING_ZONE["enabled"]:
+                pages = land_raw_epc_pages(pages, year, month)
+            epc_y_m = [normalize_raw_epc(page) for page in pages]
             
-            # Transform: Normalization
-            if not epc_y_m.empty:
-                epc_y_m = normalize_raw_epc(epc_y_m)
+            if epc_y_m:
+                # Concatenate once per month and deduplicate once on the certificate key
+                epc_y_m = helper_transform.concat_frames(epc_y_m)
+                epc_y_m.drop_duplicates(subset=['lmk_key'], inplace=True, ignore_index=True)
 
                 # Load: Load to database
-                epc_y_m.to_sql(PIPELINE_OUTPUT["table_name"], con= mydb, schema=PIPELINE_OUTPUT["db_schema"], if_exists='append', index=False)
+                load_epc(epc_y_m, mydb)
                 logging.info(f"Processing done for {month}-{year} with {epc_y_m.shape[0]} records.")
             else:
                 logging.warning(f"No data for {month}-{year}")        
 
-        #TODO: drop duplicates from from database
-        drop_duplicates_query = f"""DELETE FROM {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T1
-                                    USING       {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T2
-                                    WHERE  T1.ctid < T2.ctid       -- delete the "older" ones
-                                        AND  T1.lmk_key    = T2.lmk_key       -- list columns that define duplicates
-                                """
-        db_func.execute_sql_query(drop_duplicates_query, mydb)
-
         logging.info(f"""Update done for {year}.""")
 
     # Disconnect from database
@@ -0,0 +1,95 @@
+# Import pipeline's configs
+from .config import *
+
+# Import custom modules
+from libraries import db_functions as db_func
+from . import extractor as epc_extractor
+
+# Import py libs
+import pandas as pd
+import logging
+import zipfile
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# Define global variables
+OUTPUT_TABLE_NAME = "residential_energy_performance_certificate"
+PIPELINE_INPUT = INPUT_DATA["ARCHIVE"][OUTPUT_TABLE_NAME]
+PIPELINE_OUTPUT = OUTPUT_DATA["DB"][OUTPUT_TABLE_NAME]
+
+
+# Pipeline's helper functions
+def get_archive_members(archive_path: str) -> list[str]:
+    # One certificates file per local authority, recommendations files are skipped
+    with zipfile.ZipFile(archive_path) as z:
+        return [file_name for file_name in z.namelist() if os.path.basename(file_name) == PIPELINE_INPUT['member_file_name']]
+
+def ETL_archive_member(archive_path: str, member_name: str, chunksize: int=PIPELINE_INPUT['chunksize']) -> int:
+    # Each worker opens the archive and its own db connection, and streams its member chunk by chunk
+    mydb = db_func.connect_to_db(DB_URL)
+    nRows = 0
+
+    with zipfile.ZipFile(archive_path) as z:
+        with z.open(member_name) as f:
+            columns = pd.read_csv(f, nrows=0).columns
+
+        with z.open(member_name) as f:
+            # Extract: Read member by chunks
+            for epc in pd.read_csv(f, dtype=epc_extractor.get_epc_csv_column_types(columns), chunksize=chunksize):
+                # Transform: Normalization
+                epc = epc_extractor.normalize_raw_epc(epc)
+                epc.drop_duplicates(subset=['lmk_key'], inplace=True, ignore_index=True)
+
+                # Load: Load to database
+                epc_extractor.load_epc(epc, mydb)
+                nRows += epc.shape[0]
+
+    db_func.disconnect_db(mydb)
+    logging.info(f"Processing done for {member_name} with {nRows} records.")
+
+    return nRows
+
+
+# Pipeline's main functions
+def ETL_extract_epc_archive(archive_path: str, max_workers: int=PIPELINE_INPUT['max_workers']):
+    # Backfill from a bulk archive downloaded once, no API request is made
+    max_workers = int(max_workers)
+
+    members = get_archive_members(archive_path)
+    if not members:
+        logging.warning(f"No {PIPELINE_INPUT['member_file_name']} in {archive_path}. No data to be load!")
+        return None
+
+    logging.info(f"Started processing {len(members)} files from {archive_path}.")
+
+    # Connect to db
+    mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_residential_energy_performance_certificate.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_residential_epc_linkage_keys.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_linkage_dirty_postcodes.sql", mydb)
+
+    nRows = 0
+    if max_workers <= 1:
+        for member_name in members:
+            nRows += ETL_archive_member(archive_path, member_name)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(ETL_archive_member, archive_path, member_name) for member_name in members]
+            for future in as_completed(futures):
+                nRows += future.result()
+
+    # Disconnect from database
+    db_func.disconnect_db(mydb)
+
+    logging.info(f"Archive update done for {archive_path} with {nRows} records.")
+
+def main(*args):
+    logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S %Z')
+
+    ETL_extract_epc_archive(*args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Import pipeline's configs
+from .config import *
+
+# Import custom modules
+from libraries import db_functions as db_func
+from libraries import helper_transformation_functions as helper_transform
+from libraries import landing_functions as landing_func
+from . import extractor as epc_extractor
+
+# Import py libs
+import logging
+
+
+# Pipeline's main functions
+def ETL_replay_epc(from_year: int=None, to_year: int=None):
+    # Normalize and load again the pages landed by the extractor, no API request is made
+    partitions = landing_func.get_partitions(LANDING_ZONE["path"], epc_extractor.LANDING_SOURCE, from_year, to_year)
+    if not partitions:
+        logging.warning(f"No landed data in {LANDING_ZONE['path']}. No data to be load!")
+        return None
+
+    logging.info(f"Started replaying {len(partitions)} landed months.")
+
+    # Connect to db
+    mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_residential_energy_performance_certificate.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_residential_epc_linkage_keys.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_linkage_dirty_postcodes.sql", mydb)
+
+    for year, month in partitions:
+        # Extract & Transform: Read landed pages, each page normalized as it is read
+        epc_y_m = [epc_extractor.normalize_raw_epc(page) for page in landing_func.read_partition(LANDING_ZONE["path"], epc_extractor.LANDING_SOURCE, year, month)]
+
+        if epc_y_m:
+            # Concatenate once per month and deduplicate once on the certificate key
+            epc_y_m = helper_transform.concat_frames(epc_y_m)
+            epc_y_m.drop_duplicates(subset=['lmk_key'], inplace=True, ignore_index=True)
+
+            # Load: Load to database
+            epc_extractor.load_epc(epc_y_m, mydb)
+            logging.info(f"Replay done for {month}-{year} with {epc_y_m.shape[0]} records.")
+
+    # Disconnect from database
+    db_func.disconnect_db(mydb)
+
+    logging.info(f"Replay done for {len(partitions)} landed months.")
+
+def main(*args):
+    logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S %Z')
+
+    ETL_replay_epc(*args)
+
+
+if __name__ == "__main__":
+    main()
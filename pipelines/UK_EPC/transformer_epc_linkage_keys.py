@@ -0,0 +1,84 @@
+# Import pipeline's configs
+from .config import *
+
+# Import custom modules
+from libraries import db_functions as db_func
+from libraries import helper_transformation_functions as helper_transform
+from pipelines.UK_PPD import link_functions as link_func
+
+# Import py libs
+import pandas as pd
+import logging
+from sqlalchemy.engine import Engine
+
+
+# Define global variables
+OUTPUT_TABLE_NAME = "residential_epc_linkage_keys"
+PIPELINE_INPUT = INPUT_DATA["DB"]["residential_energy_performance_certificate"]
+PIPELINE_OUTPUT = OUTPUT_DATA["DB"][OUTPUT_TABLE_NAME]
+
+
+# Pipeline's helper functions
+def build_epc_linkage_keys(epc: pd.DataFrame) -> pd.DataFrame:
+    # Normalize epc address fields, categorical fields are read as plain strings
+    epc = epc[PIPELINE_INPUT['needed_columns']].astype(object).drop_duplicates()
+    epc = helper_transform.standardardize_nan(epc, NAN_PATTERNS, standard="")
+    epc = epc.fillna("")
+    epc = link_func.normalize_address_variables(epc)
+
+    # Derive all keys read by the linkage rules
+    epc_features = link_func.epc_feature_store(epc[['lmk_key', 'postcode', 'add', 'add1', 'add2', 'add3', 'property_type']])
+    epc_linkage_keys = link_func.get_epc_frame(epc_features, PIPELINE_OUTPUT["column_types"].keys())
+    epc_linkage_keys = epc_linkage_keys.astype(PIPELINE_OUTPUT["column_types"])
+
+    return epc_linkage_keys
+
+def load_epc_linkage_keys(epc: pd.DataFrame, mydb: Engine):
+    epc_linkage_keys = build_epc_linkage_keys(epc)
+    db_func.copy_to_table(epc_linkage_keys, PIPELINE_OUTPUT["table_name"], PIPELINE_OUTPUT["db_schema"], PIPELINE_OUTPUT["column_types"], mydb, conflict_columns=PIPELINE_OUTPUT["unique_columns"])
+    logging.info(f"Linkage keys loaded for {epc_linkage_keys.shape[0]} certificates.")
+
+
+# Pipeline's main functions
+def ETL_epc_linkage_keys(from_year: int=None, to_year: int=None):
+    # Backfill the linkage keys of certificates already loaded, by lodgement year
+
+    # Get current date
+    current_date, current_month, current_year = helper_transform.get_current_datetime()
+
+    from_year = EPC_MIN_YEAR if from_year is None else int(from_year)
+    to_year = current_year if to_year is None else int(to_year)
+
+    if (from_year > to_year) or (to_year > current_year) or (from_year < EPC_MIN_YEAR):
+        raise ValueError("Invalid year range.")
+
+    # Connect to db
+    mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_residential_epc_linkage_keys.sql", mydb)
+
+    for year in range(from_year, to_year + 1):
+        # Extract: Get epc address fields of year
+        epc_query = f"""SELECT {', '.join(PIPELINE_INPUT['needed_columns'])} FROM {PIPELINE_INPUT['db_schema']}.{PIPELINE_INPUT['table_name']}
+                        WHERE EXTRACT(year FROM "lodgement_date") = {year}::numeric;"""
+        epc = pd.read_sql(epc_query, mydb)
+
+        if epc.empty:
+            logging.warning(f"No data for {year}")
+            continue
+
+        # Transform & Load: Compute and load linkage keys
+        load_epc_linkage_keys(epc, mydb)
+        logging.info(f"Update done for {year}.")
+
+    # Disconnect from database
+    db_func.disconnect_db(mydb)
+
+def main(*args):
+    logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S %Z')
+
+    ETL_epc_linkage_keys(*args)
+
+
+if __name__ == "__main__":
+    main()
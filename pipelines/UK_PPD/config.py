@@ -14,28 +14,56 @@ DB_URL = str(os.getenv("DB_URL"))
 
 # PPD data is available from this year
 PPD_MIN_YEAR = 1995
+# Years downloaded and normalized concurrently by the yearly backfill, loaded by a single writer
+PPD_YEARLY_MAX_WORKERS = int(os.getenv("PPD_YEARLY_MAX_WORKERS", 1))
+
+# Linkage runs postcode chunks on a process pool when more than one worker is used
+LINKAGE_POSTCODE_CHUNKSIZE = 5000
+LINKAGE_MAX_WORKERS = int(os.getenv("LINKAGE_MAX_WORKERS", 1))
+LINKAGE_MAX_CHUNKS_IN_FLIGHT_PER_WORKER = 2
+# EPC records of a linkage run are streamed ordered by postcode, in blocks of about this many rows
+LINKAGE_EPC_BLOCK_ROWS = 100000
+# Years of transactions linked together, so that repeat sales of an address are linked once
+LINKAGE_YEARS_PER_RUN = int(os.getenv("LINKAGE_YEARS_PER_RUN", 1))
+
+# Source files are downloaded only when changed since the last loaded download recorded in the manifest
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")
+DOWNLOAD_MANIFEST_PATH = os.getenv("DOWNLOAD_MANIFEST_PATH", os.path.join(DOWNLOAD_DIR, "manifest.json"))
+
+# Raw pulls are persisted as parquet partitioned by source, year and month when enabled, to be replayed without network
+LANDING_ZONE = {"path": os.getenv("LANDING_ZONE_PATH", "landing"),
+                "enabled": os.getenv("LANDING_ZONE_ENABLED", "false").lower() == "true",
+                "compression": "zstd"}
 
 COLUMN_TYPES = {"price_paid":  {"transactionid": "string",
                                 "price": int,
                                 "dateoftransfer": "datetime64[ns]",
                                 "postcode": "string",
-                                "propertytype": "string",
-                                "oldnew": "string",
-                                "duration": "string",
+                                "propertytype": "category",
+                                "oldnew": "category",
+                                "duration": "category",
                                 "paon": "string",
                                 "saon": "string",
                                 "street": "string",
                                 "locality": "string",
-                                "towncity": "string",
-                                "district": "string",
-                                "county": "string",
-                                "categorytype": "string",
-                                "recordstatus": "string"
+                                "towncity": "category",
+                                "district": "category",
+                                "county": "category",
+                                "categorytype": "category",
+                                "recordstatus": "category"
                                 },
 
                 "pricepaid_to_residential_epc": {"transactionid": "string",
                                                  "lmk_key": "string"},
 
+                "linkage_dirty_postcodes": {"postcode": "string",
+                                            "source": "string",
+                                            "marked_at": "datetime64[ns]"},
+
+                "price_paid_changes": {"transactionid": "string",
+                                       "recordstatus": "string",
+                                       "changed_at": "datetime64[ns]"},
+
                 "pricepaid_enriched_with_residential_epc": {"transactionid": "string",
                                                             "price": int,
                                                             "dateoftransfer": "datetime64[ns]",
@@ -148,22 +176,35 @@ COLUMN_TYPES = {"price_paid":  {"transactionid": "string",
                 }
 
 NAN_PATTERNS = ["N/A", "NaN", "nan", "unknown", "UNKNOWN", "Unknown", "INVALID!", "NODATA!", "NO DATA!", ""]
+DATETIME_FORMATS = {"dateoftransfer": "%Y-%m-%d %H:%M"}
 
-# OUTPUT_DATA -> connection -> output_table_name -> bucket, country, subject, source, table_name, path_date_params, file_extension, column_types
+# OUTPUT_DATA -> connection -> output_table_name -> bucket, country, subject, source, table_name, path_date_params, file_extension, column_types, unique_columns
 OUTPUT_DATA = {"DB":   {"price_paid":  {"table_name": "price_paid",
                                         "db_schema": "linked_ppd_epc",
-                                        "column_types": COLUMN_TYPES["price_paid"]
+                                        "column_types": COLUMN_TYPES["price_paid"],
+                                        "unique_columns": ["transactionid"]
                                         },
                       
                         "pricepaid_to_residential_epc": {"table_name": "pricepaid_to_residential_epc",
                                                          "db_schema": "linked_ppd_epc",
-                                                         "column_types": COLUMN_TYPES["pricepaid_to_residential_epc"]
+                                                         "column_types": COLUMN_TYPES["pricepaid_to_residential_epc"],
+                                                         "unique_columns": ["transactionid", "lmk_key"]
                                                         },
                         
                         "pricepaid_enriched_with_residential_epc": {"table_name": "pricepaid_enriched_with_residential_epc",
                                                                     "db_schema": "linked_ppd_epc",
                                                                     "column_types": COLUMN_TYPES["pricepaid_enriched_with_residential_epc"]
                                                                     },
+
+                        "linkage_dirty_postcodes": {"table_name": "linkage_dirty_postcodes",
+                                                    "db_schema": "linked_ppd_epc",
+                                                    "column_types": COLUMN_TYPES["linkage_dirty_postcodes"]
+                                                    },
+
+                        "price_paid_changes": {"table_name": "price_paid_changes",
+                                               "db_schema": "linked_ppd_epc",
+                                               "column_types": COLUMN_TYPES["price_paid_changes"]
+                                               },
                         }
                 }
 
@@ -173,12 +214,15 @@ INPUT_DATA = {"SOURCE": {"price_paid": {"endpoint_url_types": ["complete", "year
                                         "endpoint_url_complete": "http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/pp-complete.csv",
                                         "endpoint_url_yearly": "http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/pp-<YEAR>.csv",
                                         "endpoint_url_half_yearly": "http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/pp-<YEAR>-part<PART_NUMBER>.csv",
+                                        "chunksize": 500000
                                         }
                         },
 
               "DB": {"price_paid": OUTPUT_DATA["DB"]["price_paid"],
                      
                         "residential_energy_performance_certificate": EPC_OUTPUT_DATA["DB"]["residential_energy_performance_certificate"],
+                        
+                        "residential_epc_linkage_keys": EPC_OUTPUT_DATA["DB"]["residential_epc_linkage_keys"],
 
                         "pricepaid_to_residential_epc": OUTPUT_DATA["DB"]["pricepaid_to_residential_epc"]
                         }
@@ -187,3 +231,4 @@ INPUT_DATA = {"SOURCE": {"price_paid": {"endpoint_url_types": ["complete", "year
 # Update params for INPUT_DATA
 INPUT_DATA["DB"]["price_paid"]["needed_columns"] = ["transactionid", "postcode", "propertytype", "paon", "saon", "street", "locality"]
 INPUT_DATA["DB"]["residential_energy_performance_certificate"]["needed_columns"] = ["lmk_key", "address1", "address2", "address3", "postcode", "property_type", "address"]
+INPUT_DATA["DB"]["residential_epc_linkage_keys"]["needed_columns"] = list(EPC_OUTPUT_DATA["DB"]["residential_epc_linkage_keys"]["column_types"].keys())
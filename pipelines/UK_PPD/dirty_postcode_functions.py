@@ -0,0 +1,62 @@
+# Import pipeline's configs
+from .config import *
+
+# Import custom modules
+from libraries import db_functions as db_func
+
+# Import py libs
+import pandas as pd
+import logging
+from sqlalchemy import text
+from sqlalchemy.engine import Engine, Connection
+
+
+# Define global variables
+DIRTY_POSTCODES = OUTPUT_DATA["DB"]["linkage_dirty_postcodes"]
+PRICE_PAID = OUTPUT_DATA["DB"]["price_paid"]
+CHANGED_TRANSACTIONS = OUTPUT_DATA["DB"]["price_paid_changes"]
+
+
+# Postcodes touched by the extractors, to be relinked by the next incremental linkage run
+def mark_dirty_postcodes(postcodes: pd.Series, source: str, mydb: Engine):
+    dirty_postcodes = pd.DataFrame({'postcode': pd.Series(postcodes).dropna().unique()})
+    if dirty_postcodes.empty: return
+
+    dirty_postcodes['source'] = source
+    dirty_postcodes['marked_at'] = pd.Timestamp.now()
+    dirty_postcodes = dirty_postcodes.astype(DIRTY_POSTCODES["column_types"])
+
+    db_func.copy_to_table(dirty_postcodes, DIRTY_POSTCODES["table_name"], DIRTY_POSTCODES["db_schema"], DIRTY_POSTCODES["column_types"], mydb)
+    logging.info(f"{dirty_postcodes.shape[0]} postcodes marked for relinking by {source}.")
+
+def get_dirty_postcodes(mydb: Engine, marked_until: pd.Timestamp) -> list:
+    dirty_postcodes_query = f"""SELECT DISTINCT postcode FROM {DIRTY_POSTCODES["db_schema"]}.{DIRTY_POSTCODES["table_name"]}
+                                WHERE marked_at <= :marked_until;"""
+    dirty_postcodes = pd.read_sql(text(dirty_postcodes_query), mydb, params={'marked_until': marked_until})
+
+    return dirty_postcodes['postcode'].tolist()
+
+def clear_dirty_postcodes(postcodes: list, marked_until: pd.Timestamp, conn: Connection):
+    # Postcodes marked again after the run started are kept for the next run
+    clear_query = f"""DELETE FROM {DIRTY_POSTCODES["db_schema"]}.{DIRTY_POSTCODES["table_name"]}
+                      WHERE postcode = ANY(:postcodes) AND marked_at <= :marked_until;"""
+    conn.execute(text(clear_query), {'postcodes': postcodes, 'marked_until': marked_until})
+
+def clear_relinked_postcodes(from_year: int, to_year: int, marked_until: pd.Timestamp, conn: Connection):
+    # A yearly relink covers a postcode only if all its transactions are of the relinked years
+    clear_query = f"""DELETE FROM {DIRTY_POSTCODES["db_schema"]}.{DIRTY_POSTCODES["table_name"]} D
+                      WHERE D.marked_at <= :marked_until
+                          AND NOT EXISTS (SELECT 1 FROM {PRICE_PAID["db_schema"]}.{PRICE_PAID["table_name"]} P
+                                          WHERE P.postcode = D.postcode
+                                              AND EXTRACT(year FROM P."dateoftransfer") NOT BETWEEN {from_year}::numeric AND {to_year}::numeric);"""
+    nCleared = conn.execute(text(clear_query), {'marked_until': marked_until}).rowcount
+    logging.info(f"{nCleared} dirty postcode marks cleared by the relink of {from_year}-{to_year}.")
+
+# Transactions added, changed or deleted by a monthly update, for downstream stages to reprocess
+def mark_changed_transactions(transactions: pd.DataFrame, conn: Connection):
+    changed_transactions = transactions[['transactionid', 'recordstatus']].copy()
+    changed_transactions['changed_at'] = pd.Timestamp.now()
+    changed_transactions = changed_transactions.astype(CHANGED_TRANSACTIONS["column_types"])
+
+    db_func.copy_to_table(changed_transactions, CHANGED_TRANSACTIONS["table_name"], CHANGED_TRANSACTIONS["db_schema"], CHANGED_TRANSACTIONS["column_types"], conn)
+    logging.info(f"{changed_transactions.shape[0]} transactions marked as changed.")
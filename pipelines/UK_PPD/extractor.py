@@ -4,23 +4,40 @@ from .config import *
 # Import custom modules
 from libraries import db_functions as db_func
 from libraries import helper_transformation_functions as helper_transform
+from libraries import http_functions as http_func
+from libraries import landing_functions as landing_func
+from . import dirty_postcode_functions as dirty_func
+from . import transformer_ppd_to_epc_mapping_keys as mapping_keys
 
 # Import py libs
 import pandas as pd
 import numpy as np
 import requests
-import io
+import os
 import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from typing import Iterator
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
 
 
 # Define global variables
 OUTPUT_TABLE_NAME = "price_paid"
 PIPELINE_INPUT = INPUT_DATA["SOURCE"][OUTPUT_TABLE_NAME]
 PIPELINE_OUTPUT = OUTPUT_DATA["DB"][OUTPUT_TABLE_NAME]
+MAPPING_OUTPUT = OUTPUT_DATA["DB"]["pricepaid_to_residential_epc"]
+LANDING_SOURCES = {"yearly": "ppd_yearly", "current_month": "ppd_monthly"}
 
 
 # Pipeline's helper functions
-def get_ppd_from_api_by_interval(by_interval="yearly", year=None, part_number=None, verbose=False) -> tuple[pd.DataFrame, int, str]:
+def get_ppd_csv_column_types() -> dict:
+    # C parser dtypes of the string and categorical columns, the parser infers the numeric ones
+    csv_column_types = {"string": str, "category": "category"}
+    return {column: csv_column_types[column_type] for column, column_type in PIPELINE_OUTPUT["column_types"].items()
+            if column_type in csv_column_types}
+
+def get_ppd_from_api_by_interval(by_interval="yearly", year=None, part_number=None, verbose=False) -> tuple[pd.DataFrame, int, str, dict]:
     if by_interval not in PIPELINE_INPUT["endpoint_url_types"]: raise ValueError("PPD can only be extracted by " + ", ".join(PIPELINE_INPUT["endpoint_url_types"]))
     
     api_url = PIPELINE_INPUT[f"endpoint_url_{by_interval}"]
@@ -35,30 +52,118 @@ def get_ppd_from_api_by_interval(by_interval="yearly", year=None, part_number=No
 
     if verbose: print(f"Extracting from API URL: {api_url}")
     
-    ppd_response = requests.get(api_url)
-    ppd = ppd_response.content
-    ppd = pd.read_csv(io.StringIO(ppd.decode('utf-8')),header=None)
-    
-    api_status_code = ppd_response.status_code
+    # Download only when the file changed since the last loaded download, 304 otherwise
+    file_path = os.path.join(DOWNLOAD_DIR, os.path.basename(api_url))
+    try:
+        download = http_func.download_if_changed(api_url, file_path, DOWNLOAD_MANIFEST_PATH)
+    except requests.HTTPError as e:
+        return pd.DataFrame(), e.response.status_code, api_url, None
+
+    if download is None:
+        return pd.DataFrame(), 304, api_url, None
+
+    ppd = pd.read_csv(file_path, header=None, names=list(PIPELINE_OUTPUT["column_types"].keys()), dtype=get_ppd_csv_column_types())
+    os.remove(file_path)
+
+    return ppd, 200, api_url, download
 
-    return ppd, api_status_code, api_url
+def stream_ppd_chunks(source: str, chunksize: int=PIPELINE_INPUT['chunksize']) -> Iterator[pd.DataFrame]:
+    # Read a local file or the response body as it arrives, one typed chunk at a time
+    column_names = list(PIPELINE_OUTPUT["column_types"].keys())
+    column_types = get_ppd_csv_column_types()
+
+    if os.path.exists(source):
+        yield from pd.read_csv(source, header=None, names=column_names, dtype=column_types, chunksize=chunksize)
+        return
+
+    with requests.get(source, stream=True) as ppd_response:
+        ppd_response.raise_for_status()
+        ppd_response.raw.decode_content = True
+        yield from pd.read_csv(ppd_response.raw, header=None, names=column_names, dtype=column_types, chunksize=chunksize)
+
+def land_raw_ppd(ppd: pd.DataFrame, interval: str, year: int, month: int=None):
+    # Yearly files are landed by month of transfer, the monthly update as the month it was pulled
+    if month is None:
+        for month in range(1, 13):
+            landing_func.clear_partition(LANDING_ZONE["path"], LANDING_SOURCES[interval], year, month)
+        partitions = ppd.groupby(ppd['dateoftransfer'].str[5:7].astype(int))
+    else:
+        landing_func.clear_partition(LANDING_ZONE["path"], LANDING_SOURCES[interval], year, month)
+        partitions = [(month, ppd)]
+
+    for month, ppd_month in partitions:
+        landing_func.write_partition(ppd_month, LANDING_ZONE["path"], LANDING_SOURCES[interval], year, month, compression=LANDING_ZONE["compression"])
+
+def extract_ppd_year(year: int) -> tuple[int, pd.DataFrame, int, str, dict]:
+    ppd, api_status_code, api_url, download = get_ppd_from_api_by_interval("yearly", year=year)
+    if api_status_code == 200 and not ppd.empty:
+        if LANDING_ZONE["enabled"]:
+            land_raw_ppd(ppd, "yearly", year)
+        ppd = normalize_raw_ppd(ppd)
+
+    return year, ppd, api_status_code, api_url, download
+
+def extract_ppd_years(years: list, max_workers: int=1) -> Iterator[tuple[int, pd.DataFrame, int, str, dict]]:
+    # At most max_workers years are in flight, so that memory stays bounded when the writer is slower
+    if max_workers <= 1:
+        for year in years:
+            yield extract_ppd_year(year)
+        return
+
+    years = iter(years)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(extract_ppd_year, year) for year in islice(years, max_workers)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                pending.update(executor.submit(extract_ppd_year, year) for year in islice(years, 1))
 
 def normalize_raw_ppd(ppd) -> pd.DataFrame:
     # Standardize column names
     ppd.columns = list(PIPELINE_OUTPUT["column_types"].keys())
     
-    # Standardize nan
-    ppd = helper_transform.standardardize_nan(ppd, NAN_PATTERNS, standard=np.nan)
-
-    # Assign dtype
-    ppd = ppd.astype(PIPELINE_OUTPUT["column_types"])
-    ppd = helper_transform.standardardize_nan(ppd, NAN_PATTERNS, standard=np.nan)
+    # Standardize nan & assign dtype
+    ppd = helper_transform.normalize_column_types(ppd, PIPELINE_OUTPUT["column_types"], NAN_PATTERNS, DATETIME_FORMATS)
 
     # Drop duplicates
     ppd.drop_duplicates(inplace=True)
     
     return ppd
 
+def load_ppd(ppd: pd.DataFrame, mydb: Engine):
+    # Yearly and complete files are linked by the yearly relink of their years, their postcodes are not marked dirty
+    db_func.copy_to_table(ppd, PIPELINE_OUTPUT["table_name"], PIPELINE_OUTPUT["db_schema"], PIPELINE_OUTPUT["column_types"], mydb, conflict_columns=PIPELINE_OUTPUT["unique_columns"])
+
+def merge_ppd_monthly_update(ppd: pd.DataFrame, mydb: Engine) -> list:
+    # Apply adds (A), changes (C) and deletes (D) in one transaction, the last record of a transaction wins
+    ppd = ppd.drop_duplicates(subset=['transactionid'], keep='last')
+    is_deleted = (ppd['recordstatus'] == 'D').to_numpy(dtype=bool)
+
+    with mydb.begin() as conn:
+        # Postcodes of the changed and deleted transactions before the update, their links are stale too
+        db_func.copy_values_to_temp_table(ppd['transactionid'].tolist(), "ppd_update_transactions", "transactionid", conn)
+        previous_postcodes_query = f"""SELECT DISTINCT P.postcode FROM {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} P
+                                           INNER JOIN ppd_update_transactions T ON P.transactionid = T.transactionid;"""
+        previous_postcodes = pd.read_sql(text(previous_postcodes_query), conn)['postcode']
+
+        # Delete transactions and their links
+        db_func.copy_values_to_temp_table(ppd.loc[is_deleted, 'transactionid'].tolist(), "ppd_deleted_transactions", "transactionid", conn)
+        for output in [PIPELINE_OUTPUT, MAPPING_OUTPUT]:
+            delete_query = f"""DELETE FROM {output["db_schema"]}.{output["table_name"]} T1
+                               USING       ppd_deleted_transactions T2
+                               WHERE  T1.transactionid = T2.transactionid;"""
+            conn.execute(text(delete_query))
+
+        # Add and change transactions
+        db_func.copy_to_table(ppd[~is_deleted], PIPELINE_OUTPUT["table_name"], PIPELINE_OUTPUT["db_schema"], PIPELINE_OUTPUT["column_types"], conn, conflict_columns=PIPELINE_OUTPUT["unique_columns"])
+        dirty_func.mark_changed_transactions(ppd, conn)
+
+    dirty_func.mark_dirty_postcodes(pd.concat([ppd['postcode'].astype(object), previous_postcodes]), "ppd", mydb)
+    logging.info(f"Monthly update merged: {(~is_deleted).sum()} transactions added or changed, {is_deleted.sum()} deleted.")
+
+    return ppd['transactionid'].tolist()
+
 # pipeline particular functions
 def ETL_raw_ppd_current_month():
     
@@ -69,34 +174,37 @@ def ETL_raw_ppd_current_month():
 
     # Connect to db
     mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_price_paid.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_pricepaid_to_residential_epc.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_price_paid_changes.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_linkage_dirty_postcodes.sql", mydb)
 
     # Extract: API requests
-    ppd, api_status_code, api_url = get_ppd_from_api_by_interval("current_month")
+    ppd, api_status_code, api_url, download = get_ppd_from_api_by_interval("current_month")
     
-    if api_status_code == 200 and not ppd.empty:
+    if api_status_code == 304:
+        logging.info(f"Monthly file unchanged since the last update, skipped for {current_month}-{year}.")
+
+    elif api_status_code == 200 and not ppd.empty:
         logging.info(f"""New data has been extracted from source successfully.
                          URL: {api_url}""")
+        if LANDING_ZONE["enabled"]:
+            land_raw_ppd(ppd, "current_month", year, current_month)
+
         # Transform: Normalization
         ppd = normalize_raw_ppd(ppd)
         
-        # Load: Load to database
-        ppd.to_sql(PIPELINE_OUTPUT["table_name"], con= mydb, schema=PIPELINE_OUTPUT["db_schema"], if_exists='append', index=False)
-        logging.info(f"Processing done for {current_month}-{year} with {ppd.shape[0]} records.")
+        # Load: Merge record status changes into database
+        changed_transactions = merge_ppd_monthly_update(ppd, mydb)
+        http_func.record_download(api_url, download, DOWNLOAD_MANIFEST_PATH)
+        logging.info(f"Processing done for {current_month}-{year} with {len(changed_transactions)} changed transactions.")
         
     else:
         logging.warning(f"No records for {current_month}-{year} or API request failed.")
     
-    # Drop duplicates from from database
-    drop_duplicates_query = f"""DELETE FROM {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T1
-                                USING       {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T2
-                                WHERE  T1.ctid < T2.ctid       -- delete the "older" ones
-                                    AND  T1.transactionid    = T2.transactionid;       -- list columns that define duplicates
-                            """
-    db_func.execute_sql_query(drop_duplicates_query, mydb)
-
     logging.info(f"""Monthly update done for {current_month}-{year}.""")
 
-def ETL_raw_ppd_yearly(from_year: int=None, to_year: int=None):
+def ETL_raw_ppd_yearly(from_year: int=None, to_year: int=None, max_workers: int=PPD_YEARLY_MAX_WORKERS):
 
     # Get current date
     current_date, current_month, current_year = helper_transform.get_current_datetime()
@@ -112,6 +220,7 @@ def ETL_raw_ppd_yearly(from_year: int=None, to_year: int=None):
 
     from_year = int(from_year)
     to_year = int(to_year)
+    max_workers = int(max_workers)
 
     # Check invalid year input
     if from_year > to_year or to_year > current_year-1 or from_year < PPD_MIN_YEAR:
@@ -121,49 +230,112 @@ def ETL_raw_ppd_yearly(from_year: int=None, to_year: int=None):
     
     # Connect to db
     mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_price_paid.sql", mydb)
 
-    for year in range(from_year, to_year+1):
-        from_month = 1
-        to_month = 12
+    # Extract & Transform: Years are downloaded and normalized by the workers as they finish
+    for year, ppd, api_status_code, api_url, download in extract_ppd_years(range(from_year, to_year+1), max_workers):
+        if api_status_code == 304:
+            logging.info(f"File unchanged since the last update, skipped for {year}.")
 
-        # Extract: API requests
-        ppd, api_status_code, api_url = get_ppd_from_api_by_interval("yearly", year=year)
-        
-        if api_status_code == 200 and not ppd.empty:
+        elif api_status_code == 200 and not ppd.empty:
             logging.info(f"""New data has been extracted from source successfully.
                             URL: {api_url}""")
-            # Transform: Normalization
-            ppd = normalize_raw_ppd(ppd)
             
             # Load: Load to database
-            ppd.to_sql(PIPELINE_OUTPUT["table_name"], con= mydb, schema=PIPELINE_OUTPUT["db_schema"], if_exists='append', index=False)
+            load_ppd(ppd, mydb)
+            http_func.record_download(api_url, download, DOWNLOAD_MANIFEST_PATH)
             logging.info(f"Processing done for {year} with {ppd.shape[0]} records.")
         else:
             logging.warning(f"No records for {year} or API request failed.")
-        
-        #TODO: drop duplicates from from database
-        drop_duplicates_query = f"""DELETE FROM {PIPELINE_OUTPUT['db_schema']}.{PIPELINE_OUTPUT['table_name']} T1
-                                    USING       {PIPELINE_OUTPUT['db_schema']}.{PIPELINE_OUTPUT['table_name']} T2
-                                    WHERE  T1.ctid < T2.ctid
-                                        AND  T1.transactionid    = T2.transactionid;
-                                """
-        
-        db_func.execute_sql_query(drop_duplicates_query, mydb)
-
-        logging.info(f"""Update done for {year}.""")
 
     # Disconnect from database
     db_func.disconnect_db(mydb)
     logging.info(f"""Yearly update done for {from_year}-{to_year}.""")
 
-def ETL_raw_ppd(interval: str="current_month", from_year: int=None, to_year: int=None):
+def ETL_raw_ppd_complete(file_path: str=None, chunksize: int=PIPELINE_INPUT['chunksize'], relink: bool=False):
+    # Stream the complete file from the source, or from an already downloaded copy, with bounded memory
+    source = PIPELINE_INPUT["endpoint_url_complete"] if file_path is None or file_path == "" else file_path
+    chunksize = int(chunksize)
+    relink = str(relink).lower() in ["true", "relink"]
+
+    logging.info(f"Started processing all transactions from {source}.")
+
+    # Connect to db
+    mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_price_paid.sql", mydb)
+
+    nRows = 0
+    # Extract: Read by chunks
+    for ppd in stream_ppd_chunks(source, chunksize):
+        # Transform: Normalization
+        ppd = normalize_raw_ppd(ppd)
+
+        # Load: Load to database
+        load_ppd(ppd, mydb)
+        nRows += ppd.shape[0]
+        logging.info(f"{nRows} records loaded.")
+
+    # Disconnect from database
+    db_func.disconnect_db(mydb)
+    logging.info(f"""Complete update done with {nRows} records.""")
+
+    # Transform & Load: Full relink of all years on request only, it is otherwise run as its own stage
+    if relink:
+        mapping_keys.ETL_ppd_epc_mapping_keys(PPD_MIN_YEAR)
+    else:
+        logging.info(f"Links not refreshed, run the full relink from {PPD_MIN_YEAR} to cover the reloaded transactions.")
+
+def ETL_raw_ppd_replay(interval: str="yearly", from_year: int=None, to_year: int=None):
+    # Normalize and load again from the landing zone alone, no request is made
+    if interval not in LANDING_SOURCES: raise ValueError("Only " + ", ".join(LANDING_SOURCES) + " pulls can be replayed.")
+
+    partitions = landing_func.get_partitions(LANDING_ZONE["path"], LANDING_SOURCES[interval], from_year, to_year)
+    if not partitions:
+        logging.warning(f"No landed {interval} data in {LANDING_ZONE['path']}. No data to be load!")
+        return None
+
+    logging.info(f"Started replaying {len(partitions)} landed months of {interval} data.")
+
+    # Connect to db
+    mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_price_paid.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_pricepaid_to_residential_epc.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_price_paid_changes.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_linkage_dirty_postcodes.sql", mydb)
+
+    # Monthly updates are merged in the order they were pulled
+    for year, month in partitions:
+        nRows = 0
+        # Extract: Read landed parts
+        for ppd in landing_func.read_partition(LANDING_ZONE["path"], LANDING_SOURCES[interval], year, month):
+            # Transform: Normalization
+            ppd = normalize_raw_ppd(ppd)
+
+            # Load: Load to database
+            if interval == "current_month":
+                merge_ppd_monthly_update(ppd, mydb)
+            else:
+                load_ppd(ppd, mydb)
+            nRows += ppd.shape[0]
+
+        logging.info(f"Replay done for {month}-{year} with {nRows} records.")
+
+    # Disconnect from database
+    db_func.disconnect_db(mydb)
+    logging.info(f"""Replay done for {interval} data.""")
+
+def ETL_raw_ppd(interval: str="current_month", *args):
 
     if interval == "current_month":
         ETL_raw_ppd_current_month()
     elif interval == "yearly":
-        ETL_raw_ppd_yearly(from_year=from_year, to_year=to_year)
+        ETL_raw_ppd_yearly(*args)
+    elif interval == "complete":
+        ETL_raw_ppd_complete(*args)
+    elif interval == "replay":
+        ETL_raw_ppd_replay(*args)
     else:
-        raise ValueError(f"Invalid interval input! Only 'current_month' and 'yearly' are allowed.")
+        raise ValueError(f"Invalid interval input! Only 'current_month', 'yearly', 'complete' and 'replay' are allowed.")
 
 def main(*args):
     logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import warnings
 
 # Disable (false positive) warning
@@ -16,95 +17,354 @@ def normalize_address_variables(df):
     return df
 
 
+# Define address normalization kernel
+def combine_fields(parts, strip=False, delete=""):
+    # Concatenate fields and separators, then strip and delete characters, in one pass over the records
+    index = next(part.index for part in parts if isinstance(part, pd.Series))
+    values = None
+    for part in parts:
+        part = part.astype(str).values if isinstance(part, pd.Series) else part
+        values = part if values is None else values + part
+    
+    if strip or delete:
+        # Chained str.replace beats str.translate (deletion tables miss its ascii fast path) and a compiled
+        # character class regex: 0.21s vs 0.73s vs 0.51s deleting "'." from 500k values, 0.48s vs 0.70s vs 0.80s for " './,"
+        combined = []
+        for value in values:
+            if strip: value = value.strip()
+            for char in delete:
+                value = value.replace(char, "")
+            combined.append(value)
+        values = combined
+    
+    return pd.Series(values, index=index, dtype=object)
+
+def split_field(field, sep):
+    # First part and remainder of a field split once on a separator (None without separator)
+    parts = [value.split(sep, 1) for value in map(str, field.values)]
+    first = pd.Series([part[0] for part in parts], index=field.index, dtype=object)
+    rest = pd.Series([part[1] if len(part) > 1 else None for part in parts], index=field.index, dtype=object)
+    
+    return first, rest
+
+def first_word(field):
+    return pd.Series([value.split(" ", 1)[0] for value in map(str, field.values)], index=field.index, dtype=object)
+
+def last_word(field):
+    return pd.Series([value.split(" ")[-1] for value in map(str, field.values)], index=field.index, dtype=object)
+
+
+# Define per-chunk store of epc address variables
+def epc_feature_store(epc):
+    # Address variables of the epc records of a chunk, each derived on first use and kept for later stages,
+    # with the postcode block index of the records kept under 'postcode_blocks'
+    features = {column: epc[column] for column in epc.columns}
+    features['postcode_blocks'] = build_postcode_blocks(epc['postcode'])
+    
+    return features
+
+def build_postcode_blocks(postcodes):
+    # Records sorted by postcode (as positions) and postcode -> (start, end) offsets of each block in that order.
+    # Records themselves are not moved
+    codes, block_postcodes = pd.factorize(postcodes.fillna("").values)
+    order = np.argsort(codes, kind='stable')
+    block_sizes = np.bincount(codes, minlength=len(block_postcodes))
+    ends = np.cumsum(block_sizes)
+    starts = ends - block_sizes
+    
+    return pd.DataFrame({'start': starts, 'end': ends}, index=block_postcodes), order
+
+def select_postcode_blocks(postcode_blocks, postcodes):
+    # Positions and block numbers of the records of the blocks of the given postcodes, in record order
+    blocks, order = postcode_blocks
+    block_numbers = np.flatnonzero(blocks.index.isin(postcodes))
+    starts = blocks['start'].values[block_numbers]
+    lengths = blocks['end'].values[block_numbers] - starts
+    block_offsets = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+    rows = order[block_offsets + np.arange(lengths.sum())]
+    
+    record_order = np.argsort(rows, kind='stable')
+    return rows[record_order], np.repeat(block_numbers, lengths)[record_order]
+
+def get_epc_feature(features, name):
+    if name not in features:
+        if name in EPC_DELETION_VARIANTS:
+            features[name] = derive_deletion_variant(features, name)
+        else:
+            build, inputs = EPC_FEATURES[name]
+            features[name] = build(*[get_epc_feature(features, feature) for feature in inputs])
+    
+    return features[name]
+
+def derive_deletion_variant(features, name):
+    # Derive from the stored variant of the same field deleting the largest subset of the characters
+    field, strip, chars = EPC_DELETION_VARIANTS[name]
+    sources = [source for source, (source_field, source_strip, source_chars) in EPC_DELETION_VARIANTS.items()
+               if source in features and source_field == field and source_strip == strip and set(source_chars) <= set(chars)]
+    if not sources:
+        return combine_fields([get_epc_feature(features, field)], strip=strip, delete=chars)
+    
+    source = max(sources, key=lambda source: len(set(EPC_DELETION_VARIANTS[source][2])))
+    remaining = "".join(sorted(set(chars) - set(EPC_DELETION_VARIANTS[source][2])))
+    
+    return combine_fields([features[source]], delete=remaining) if remaining else features[source]
+
+def get_epc_frame(features, columns, rows=None):
+    if rows is None:
+        return pd.DataFrame({column: get_epc_feature(features, column) for column in dict.fromkeys(columns)})
+    
+    return pd.DataFrame({column: get_epc_feature(features, column).values[rows] for column in dict.fromkeys(columns)})
+
+# Character-deletion variants of epc address fields: name -> (field, strip, deleted characters)
+EPC_DELETION_VARIANTS = {
+    # "add" is already stripped by normalize_address_variables, so its variants all share the stripped field
+    'address_final1': ('add', True, " "),
+    'address_final2': ('add', True, "'./ "),
+    'address_final3': ('add', True, "'./ -"),
+    'address_final7': ('add', True, " ,"),
+    'address_final8': ('add', True, "'./ ,"),
+    'address_final13': ('add', True, " ,"),
+    'address_final14': ('add', True, " './"),
+    'address_final15': ('add', True, " './,"),
+    'address_final20': ('add', True, " './-,"),
+    'address_final4': ('add1__add2', False, " "),
+    'address_final5': ('add1__add2', False, " './"),
+    'address_final6': ('add1__add2', False, " './,"),
+    'address_final9': ('add1__add2', False, " ,"),
+    'address_final10': ('add1__add2', False, " './-"),
+    'address_final16': ('add1__add2', True, " './"),
+    'address_final17': ('add1__add2', True, " './,"),
+    'address_final11': ('add1', True, " './-"),
+    'add1_4': ('add1', True, " './,"),
+    'add1_5': ('add1', True, " ,"),
+    'address_final19': ('add1__add3', True, " './,"),
+    'address_final24': ('add1_add2', True, " './,-"),
+    'address_final27': ('add2_add3', True, " './,"),
+    'address_final32': ('add1_add3', True, " './,"),
+    'address_final33': ('add1_add3', False, " ,"),
+}
+
+# Other derived epc address variables: name -> (build function, input variables)
+EPC_FEATURES = {
+    'add1__add2': (lambda add1, add2: combine_fields([add1, ", ", add2]), ['add1', 'add2']),
+    'add1__add3': (lambda add1, add3: combine_fields([add1, ", ", add3]), ['add1', 'add3']),
+    'add1_add2': (lambda add1, add2: combine_fields([add1, " ", add2]), ['add1', 'add2']),
+    'add1_add3': (lambda add1, add3: combine_fields([add1, " ", add3]), ['add1', 'add3']),
+    'add2_add3': (lambda add2, add3: combine_fields([add2, " ", add3]), ['add2', 'add3']),
+    'add1_comma_split': (lambda add1: split_field(add1, ","), ['add1']),
+    'add1_comma_sep1': (lambda add1_comma_split: add1_comma_split[0], ['add1_comma_split']),
+    'add1_comma_sep2': (lambda add1_comma_split: add1_comma_split[1], ['add1_comma_split']),
+    'add1_comma_sep2_1': (lambda add1_comma_sep2: add1_comma_sep2.str.replace("-", "", regex=False), ['add1_comma_sep2']),
+    # Stage 3
+    'address_final29': (lambda add1, add2: combine_fields([add1, " ", combine_fields([add2], delete="-")], delete=" './,"), ['add1', 'add2']),
+    'address_final35': (lambda add1_comma_sep1, add1_comma_sep2_1, add2: combine_fields([add1_comma_sep1, ", ", add1_comma_sep2_1, ", ", add2], delete=" ,"),
+                        ['add1_comma_sep1', 'add1_comma_sep2_1', 'add2']),
+    'address_final37': (lambda add1_comma_sep1, add1_comma_sep2: combine_fields([add1_comma_sep1, ", ", combine_fields([add1_comma_sep2], delete=".")], delete=" ,"),
+                        ['add1_comma_sep1', 'add1_comma_sep2']),
+    'address_final38': (lambda address_final13: address_final13.str.replace("UNIT ", "", regex=False), ['address_final13']),
+    'add1_firstword__add2': (lambda add1, add2: combine_fields([first_word(add1), ", ", add2]), ['add1', 'add2']),
+}
+
+
+# Columns identifying a distinct ppd address (property type is used by stage 3 filters)
+ADDRESS_COLUMNS = ['postcode', 'saon', 'paon', 'street', 'locality', 'propertytype']
+
+def dedupe_addresses(ppd):
+    # Number each distinct address, in order of first appearance
+    address_ids = ppd.groupby(ADDRESS_COLUMNS, sort=False, dropna=False).ngroup().values
+    is_first = ~pd.Series(address_ids).duplicated().values
+    
+    addresses = ppd.loc[is_first, ADDRESS_COLUMNS]
+    addresses.insert(0, 'address_id', address_ids[is_first])
+    addresses.reset_index(drop=True, inplace=True)
+    
+    return addresses, address_ids
+
+def expand_to_transactions(link_keys, ppd, address_ids):
+    # Fan address link keys out to all transactions of the address
+    transactions = pd.DataFrame({'transactionid': ppd['transactionid'].values, 'address_id': address_ids})
+    link_keys = link_keys[['address_id', 'lmk_key']].astype({'address_id': 'int64'})
+    link_keys = link_keys.merge(transactions, on='address_id', how='inner')
+    
+    return link_keys[['transactionid', 'lmk_key']]
+
+
 # Define functions for matching process
+def filter_mask(df, filter_rules):
+    mask = np.ones(df.shape[0], dtype=bool)
+    for filter in filter_rules:
+        if filter[1] == 'equal':
+            mask &= (df[filter[0]] == filter[2]).to_numpy(dtype=bool)
+        elif filter[1] == 'notequal':
+            mask &= (df[filter[0]] != filter[2]).to_numpy(dtype=bool)
+        elif filter[1] == 'innotregex':
+            mask &= df[filter[2]].str.contains(filter[0], regex=False).to_numpy(dtype=bool)
+        elif filter[1] == 'inregex':
+            mask &= df[filter[2]].str.contains(filter[0], regex=True).to_numpy(dtype=bool)
+        elif filter[1] == 'notinnotregex':
+            mask &= ~df[filter[2]].str.contains(filter[0], regex=False).to_numpy(dtype=bool)
+        elif filter[1] == 'notinregex':
+            mask &= ~df[filter[2]].str.contains(filter[0], regex=True).to_numpy(dtype=bool)
+    
+    return mask
+
+def apply_filters(df, filter_rules):
+    return df[filter_mask(df, filter_rules)]
+
 def filter_before_matching(ppd_temp, epc_temp, filter_requirements, rule):
     # Check filter requirements
     if rule in filter_requirements:
         if 'ppd' in filter_requirements[rule]:
-            filter_rules = filter_requirements[rule]['ppd']
-            for filter in filter_rules:
-                if filter[1] == 'equal':
-                    ppd_temp = ppd_temp[ppd_temp[filter[0]] == filter[2]]
-                elif filter[1] == 'notequal':
-                    ppd_temp = ppd_temp[ppd_temp[filter[0]] != filter[2]]
-                elif filter[1] == 'innotregex':
-                    ppd_temp = ppd_temp[ppd_temp[filter[2]].str.contains(filter[0], regex=False)]
-                elif filter[1] == 'inregex':
-                    ppd_temp = ppd_temp[ppd_temp[filter[2]].str.contains(filter[0], regex=True)]
+            ppd_temp = apply_filters(ppd_temp, filter_requirements[rule]['ppd'])
                     
         if 'epc' in filter_requirements[rule]:
-            filter_rules = filter_requirements[rule]['epc']
-            for filter in filter_rules:
-                if filter[1] == 'equal':
-                    epc_temp = epc_temp[epc_temp[filter[0]] == filter[2]]
-                elif filter[1] == 'notequal':
-                    epc_temp = epc_temp[epc_temp[filter[0]] != filter[2]]
-                elif filter[1] == 'innotregex':
-                    epc_temp = epc_temp[epc_temp[filter[2]].str.contains(filter[0], regex=False)]
-                elif filter[1] == 'inregex':
-                    epc_temp = epc_temp[epc_temp[filter[2]].str.contains(filter[0], regex=True)]
-                elif filter[1] == 'notinnotregex':
-                    epc_temp = epc_temp[~(epc_temp[filter[2]].str.contains(filter[0], regex=False))]
-                elif filter[1] == 'notinregex':
-                    epc_temp = epc_temp[~(epc_temp[filter[2]].str.contains(filter[0], regex=True))]
+            epc_temp = apply_filters(epc_temp, filter_requirements[rule]['epc'])
     
     return ppd_temp, epc_temp
 
-def match_keys(ppd, epc, matching_rules, filter_requirements):
+def empty_link_keys():
+    return pd.DataFrame(columns=['addressf', 'address_id', 'lmk_key'])
+
+def select_unmatched(ppd, matched, columns, eligible=None):
+    # Positions of the records still to be matched by a stage, in the shared matched mask
+    unmatched = ~matched if eligible is None else ~matched & eligible
+    positions = np.flatnonzero(unmatched)
     
-    # Fill NAN, None
-    ppd = ppd.fillna("")
-    epc = epc.fillna("")
+    return ppd[columns].iloc[positions], positions
+
+def epc_columns_needed(matching_rules, filter_requirements):
+    # Epc variables used as keys or in filters by the rules
+    columns = ['lmk_key', 'postcode']
+    for rule in matching_rules:
+        columns.append(matching_rules[rule][1])
+        for filter in filter_requirements.get(rule, dict()).get('epc', []):
+            columns.append(filter[0] if filter[1] in ['equal', 'notequal'] else filter[2])
     
-    # Apply matching rules
-    nLinks = dict()
-    link_keys = pd.DataFrame(columns=['addressf', 'transactionid', 'lmk_key'])
+    return list(dict.fromkeys(columns))
+
+def build_epc_indexes(epc, matching_rules, filter_requirements):
+    # One hash index per distinct (epc key column, epc filters) pair used by the rules,
+    # keyed by postcode block number and normalized key
+    epc_indexes = dict()
+    index_ids = dict()
+    rule_index_ids = dict()
     
     for rule in matching_rules:
-        ppd_temp = ppd
-        epc_temp = epc
-        
-        # Check filter requirements
-        ppd_temp, epc_temp = filter_before_matching(ppd_temp, epc_temp, filter_requirements, rule)
-        
-        # Finalise matching keys
-        ppd_temp['addressf'] = ppd_temp['postcode'].astype(str) + ", " + ppd_temp[matching_rules[rule][0]].astype(str)
-        epc_temp['addressf'] = epc_temp['postcode'].astype(str) + ", " + epc_temp[matching_rules[rule][1]].astype(str)
-        
-        ppd_temp = ppd_temp[['addressf', 'transactionid']]
-        epc_temp = epc_temp[['addressf', 'lmk_key']]
+        epc_filters = filter_requirements.get(rule, dict()).get('epc', [])
+        index_spec = (matching_rules[rule][1], repr(epc_filters))
         
-        # Inner join by matching keys
-        new_link_keys = ppd_temp.join(epc_temp.set_index('addressf'), on='addressf', how='inner')
-        
-        # Collect new link keys
-        link_keys = pd.concat([link_keys, new_link_keys], ignore_index=True)
-        
-        new_link_keys_count = new_link_keys.shape[0]
-        new_unique_link_transactionids = new_link_keys['transactionid'].unique()
-        new_unique_link_transactionid_count = len(new_unique_link_transactionids)
-        prior_link_ppd_records_count = ppd_temp.shape[0]
+        if index_spec not in index_ids:
+            index_ids[index_spec] = len(index_ids)
+            epc_temp = apply_filters(epc, epc_filters)
+            epc_indexes[index_spec] = pd.DataFrame({'index_id': index_ids[index_spec],
+                                                    'block': epc_temp['block'].values,
+                                                    'key': epc_temp[index_spec[0]].astype(str).values,
+                                                    'lmk_key': epc_temp['lmk_key'].values})
+        rule_index_ids[rule] = index_ids[index_spec]
+    
+    epc_index = pd.concat(list(epc_indexes.values()), ignore_index=True)
+    
+    return epc_index, rule_index_ids
+
+def build_ppd_candidates(ppd, matching_rules, filter_requirements):
+    # Every candidate key of every rule, tagged with the rule priority and the ppd row
+    ppd_candidates = []
+    
+    for priority, rule in enumerate(matching_rules):
+        rows = np.flatnonzero(filter_mask(ppd, filter_requirements.get(rule, dict()).get('ppd', [])))
+        ppd_candidates.append(pd.DataFrame({'priority': priority,
+                                            'postcode': ppd['postcode'].astype(str).values[rows],
+                                            'key': ppd[matching_rules[rule][0]].astype(str).values[rows],
+                                            'row': rows}))
+    
+    ppd_candidates = pd.concat(ppd_candidates, ignore_index=True)
+    
+    return ppd_candidates
+
+def match_keys(ppd, epc, matching_rules, filter_requirements, matched=None, positions=None):
+    # epc: feature store of the chunk (or a data frame of the epc records)
+    if isinstance(epc, pd.DataFrame):
+        epc = epc_feature_store(epc)
+    
+    # Fill NAN, None
+    ppd = ppd.fillna("")
+    
+    # Positions of the ppd records in the shared matched mask
+    if matched is None:
+        matched = np.zeros(ppd.shape[0], dtype=bool)
+    if positions is None:
+        positions = np.arange(ppd.shape[0])
+    
+    # Build ppd candidate keys for all rules at once
+    ppd_candidates = build_ppd_candidates(ppd, matching_rules, filter_requirements)
+    
+    # Build epc indexes only for the rules having candidates, deriving only the epc variables they use,
+    # over the postcode blocks where ppd records remain to be matched
+    candidate_priorities = set(ppd_candidates['priority'].unique())
+    candidate_rules = {rule: matching_rules[rule] for priority, rule in enumerate(matching_rules) if priority in candidate_priorities}
+    if candidate_rules:
+        epc_rows, epc_blocks = select_postcode_blocks(epc['postcode_blocks'], ppd_candidates['postcode'].unique())
+        epc_temp = get_epc_frame(epc, epc_columns_needed(candidate_rules, filter_requirements), epc_rows).fillna("")
+        epc_temp['block'] = epc_blocks
+        epc_index, rule_index_ids = build_epc_indexes(epc_temp, candidate_rules, filter_requirements)
+    else:
+        epc_index = pd.DataFrame({'index_id': pd.Series(dtype='int64'), 'block': pd.Series(dtype='int64'),
+                                  'key': pd.Series(dtype=object), 'lmk_key': pd.Series(dtype=object)})
+        rule_index_ids = dict()
+    rule_index_ids = np.array([rule_index_ids.get(rule, -1) for rule in matching_rules])
+    ppd_candidates['index_id'] = rule_index_ids[ppd_candidates['priority'].values]
+    ppd_candidates['block'] = epc['postcode_blocks'][0].index.get_indexer(ppd_candidates['postcode'])
+    
+    # Probe all candidate keys in a single inner join, block-local as the block numbers stand for the postcodes.
+    # Candidates of postcodes without epc records are skipped
+    link_keys = ppd_candidates[ppd_candidates['block'].values >= 0].merge(epc_index, on=['index_id', 'block', 'key'], how='inner')
+    link_keys = link_keys.sort_values('priority', kind='stable', ignore_index=True)
+    
+    # First match wins: walk the rules in order, keeping the links of records not matched yet
+    candidate_bounds = np.searchsorted(ppd_candidates['priority'].values, np.arange(len(matching_rules) + 1))
+    link_bounds = np.searchsorted(link_keys['priority'].values, np.arange(len(matching_rules) + 1))
+    candidate_positions = positions[ppd_candidates['row'].values]
+    link_positions = positions[link_keys['row'].values]
+    is_new_link = np.zeros(link_keys.shape[0], dtype=bool)
+    
+    nLinks = dict()
+    remaining_ppd_records_count = int((~matched[positions]).sum())
+    for priority, rule in enumerate(matching_rules):
+        prior_link_ppd_records_count = int((~matched[candidate_positions[candidate_bounds[priority]:candidate_bounds[priority + 1]]]).sum())
         
-        nLinks[rule] = [new_link_keys_count, new_unique_link_transactionid_count, prior_link_ppd_records_count]
+        rule_link_positions = link_positions[link_bounds[priority]:link_bounds[priority + 1]]
+        rule_is_new_link = ~matched[rule_link_positions]
+        is_new_link[link_bounds[priority]:link_bounds[priority + 1]] = rule_is_new_link
         
         # Exclude matched records for next rounds
-        ppd = ppd[~ppd['transactionid'].isin(list(new_unique_link_transactionids))]
-        #epc = epc[~epc['lmk_key'].isin(list(ppd_epc_temp['lmk_key']))]
-        # Append after-linked-records excluded count
-        nLinks[rule].append(ppd.shape[0])
+        new_link_positions = np.unique(rule_link_positions[rule_is_new_link])
+        matched[new_link_positions] = True
+        remaining_ppd_records_count -= len(new_link_positions)
+        
+        nLinks[rule] = [int(rule_is_new_link.sum()), len(new_link_positions), prior_link_ppd_records_count, remaining_ppd_records_count]
     
-    link_keys.drop_duplicates(subset=['transactionid', 'lmk_key'], keep='first', inplace=True)
+    link_keys = link_keys[is_new_link]
+    link_keys['address_id'] = ppd['address_id'].values[link_keys['row'].values]
+    link_keys['addressf'] = link_keys['postcode'] + ", " + link_keys['key']
+    link_keys = link_keys[['addressf', 'address_id', 'lmk_key']]
+    link_keys.drop_duplicates(subset=['address_id', 'lmk_key'], keep='first', inplace=True)
+    link_keys.reset_index(drop=True, inplace=True)
     
-    return link_keys, nLinks, new_unique_link_transactionids, ppd, epc
+    new_unique_link_address_ids = link_keys['address_id'].unique()
+    
+    return link_keys, nLinks, new_unique_link_address_ids
 
 
 # Define matching stages
 
-def match_stage_1(ppd, epc):
-    # ppd: transactionid, postcode, saon, paon, street, locality
-    # epc: lmk_key, postcode, add, add1, add2
-    ppd = ppd[['transactionid', 'postcode', 'saon', 'paon', 'street', 'locality']]
-    epc = epc[['lmk_key', 'postcode', 'add', 'add1', 'add2']]
+def match_stage_1(ppd, epc, matched=None):
+    # ppd: address_id, postcode, saon, paon, street, locality
+    # epc: feature store of the chunk epc records (lmk_key, postcode, add, add1, add2, add3, property_type)
+    # matched: shared mask of ppd records matched by earlier stages, updated in place
+    if matched is None:
+        matched = np.zeros(ppd.shape[0], dtype=bool)
+    ppd, positions = select_unmatched(ppd, matched, ['address_id', 'postcode', 'saon', 'paon', 'street', 'locality'])
+    if ppd.empty: return empty_link_keys(), dict(), []
     
     # Define matching rules
     matching_rules = dict()
@@ -141,101 +401,61 @@ def match_stage_1(ppd, epc):
     
     
     # Create address variables from ppd
+    # Rule 4-6, 8-9, 13-15, 17, 19, 22, 24, 27
+    ppd['saonn'] = combine_fields([ppd['saon']], delete="/")
+    ppd['paonn'] = combine_fields([ppd['paon']], delete="'.")
+    ppd['streetn'] = combine_fields([ppd['street']], delete="'")
+    ppd['localityn'] = combine_fields([ppd['locality']], delete="'.")
     # Rule 1, 10
-    ppd['saon__paon'] = ppd[['saon','paon']].apply(", ".join, axis = 1)
-    ppd['saon__paon_street'] = ppd['saon__paon'].astype(str) + " " + ppd['street'].astype(str)
-    ppd['saon__paon_street'] = ppd['saon__paon_street'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saon__paon_street'] = combine_fields([ppd['saon'], ", ", ppd['paon'], " ", ppd['street']], strip=True, delete=" ")
     # Rule 2, 11
-    ppd['saon__paon__street'] = ppd['saon__paon'].astype(str) + ", " + ppd['street'].astype(str)
-    ppd['saon__paon__street'] = ppd['saon__paon__street'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saon__paon__street'] = combine_fields([ppd['saon'], ", ", ppd['paon'], ", ", ppd['street']], strip=True, delete=" ")
     # Rule 3, 12
-    ppd['saon_paon'] = ppd['saon'].astype(str) + " " + ppd['paon'].astype(str)
-    ppd['saon_paon1'] = ppd['saon_paon'].str.strip()
-    ppd['saon_paon1__street'] = ppd['saon_paon1'].astype(str) + ", " + ppd['street'].astype(str)
-    ppd['saon_paon1__street'] = ppd['saon_paon1__street'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saon_paon1'] = combine_fields([ppd['saon'], " ", ppd['paon']], strip=True)
+    ppd['saon_paon1__street'] = combine_fields([ppd['saon_paon1'], ", ", ppd['street']], strip=True, delete=" ")
     # Rule 4, 13
-    ppd['saonn'] = ppd['saon'].str.replace("/", "", regex=False)
-    ppd['paonn'] = ppd['paon'].str.replace("'", "", regex=False)
-    ppd['paonn'] = ppd['paonn'].str.replace(".", "", regex=False)
-    ppd['streetn'] = ppd['street'].str.replace("'", "", regex=False)
-    ppd['saonn__paonn'] = ppd['saonn'].astype(str) + ", " + ppd['paonn'].astype(str)
-    ppd['saonn__paonn_streetn'] = ppd['saonn__paonn'].astype(str) + " " + ppd['streetn'].astype(str)
-    ppd['saonn__paonn_streetn'] = ppd['saonn__paonn_streetn'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saonn__paonn_streetn'] = combine_fields([ppd['saonn'], ", ", ppd['paonn'], " ", ppd['streetn']], strip=True, delete=" ")
     # Rule 5, 14
-    ppd['saonn__paonn__streetn'] = ppd['saonn__paonn'].astype(str) + ", " + ppd['streetn'].astype(str)
-    ppd['saonn__paonn__streetn'] = ppd['saonn__paonn__streetn'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saonn__paonn__streetn'] = combine_fields([ppd['saonn'], ", ", ppd['paonn'], ", ", ppd['streetn']], strip=True, delete=" ")
     # Rule 6, 15
-    ppd['saonn_paonn'] = ppd['saonn'].astype(str) + " " + ppd['paonn'].astype(str)
-    ppd['saonn_paonn'] = ppd['saonn_paonn'].str.strip()
-    ppd['saonn_paonn__streetn'] = ppd['saonn_paonn'].astype(str) + ", " + ppd['streetn'].astype(str)
-    ppd['saonn_paonn__streetn'] = ppd['saonn_paonn__streetn'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saonn_paonn'] = combine_fields([ppd['saonn'], " ", ppd['paonn']], strip=True)
+    ppd['saonn_paonn__streetn'] = combine_fields([ppd['saonn_paonn'], ", ", ppd['streetn']], strip=True, delete=" ")
     # Rule 7, 23
-    ppd['saon_paon1__locality'] = ppd['saon_paon1'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['saon_paon1__locality'] = ppd['saon_paon1__locality'].str.replace(" ", "", regex=False)
-    # Rule 8-9, 24
-    ppd['localityn'] = ppd['locality'].str.replace("'", "", regex=False)
-    ppd['localityn'] = ppd['localityn'].str.replace(".", "", regex=False)
-    ppd['saonn_paonn__localityn'] = ppd['saonn_paonn'].astype(str) + ", " + ppd['localityn'].astype(str)
-    ppd['saonn_paonn__localityn'] = ppd['saonn_paonn__streetn'].str.replace(" ", "", regex=False)
+    ppd['saon_paon1__locality'] = combine_fields([ppd['saon_paon1'], ", ", ppd['locality']], delete=" ")
+    # Rule 8-9, 24 (same key as rule 6, as it has always been built from the street)
+    ppd['saonn_paonn__localityn'] = ppd['saonn_paonn__streetn']
     # Rule 16, 21
-    ppd['saon_paon1_street1'] = ppd['saon_paon1'].astype(str) + " " + ppd['street'].astype(str)
-    ppd['saon_paon1_street1'] = ppd['saon_paon1_street1'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saon_paon1_street1'] = combine_fields([ppd['saon_paon1'], " ", ppd['street']], strip=True, delete=" ")
     # Rule 17, 22
-    ppd['saonn_paonn_streetn1'] = ppd['saonn_paonn'].astype(str) + " " + ppd['streetn'].astype(str)
-    ppd['saonn_paonn_streetn1'] = ppd['saonn_paonn_streetn1'].str.strip().str.replace(" ", "", regex=False)
+    ppd['saonn_paonn_streetn1'] = combine_fields([ppd['saonn_paonn'], " ", ppd['streetn']], strip=True, delete=" ")
     # Rule 18, 20
-    ppd['saon__paon__street__locality'] = ppd['saon__paon__street'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['saon__paon__street__locality'] = ppd['saon__paon__street__locality'].str.replace(" ", "", regex=False)
+    ppd['saon__paon__street__locality'] = combine_fields([ppd['saon__paon__street'], ", ", ppd['locality']], delete=" ")
     # Rule 19
-    ppd['saonn__paonn__streetn__localityn'] = ppd['saonn__paonn__streetn'].astype(str) + ", " + ppd['localityn'].astype(str)
-    ppd['saonn__paonn__streetn__localityn'] = ppd['saonn__paonn__streetn__localityn'].str.replace(" ", "", regex=False)
+    ppd['saonn__paonn__streetn__localityn'] = combine_fields([ppd['saonn__paonn__streetn'], ", ", ppd['localityn']], delete=" ")
     # Rule 25
-    ppd['saon_paon2'] = ppd['saon_paon'].str.replace(" ", "", regex=False)
-    # Rule 26
-    ppd['saon_paon1_street2'] = ppd['saon_paon1_street1'].str.strip().str.replace(",", "", regex=False)
-    # Rule 27
-    ppd['saonn_paonn_streetn2'] = ppd['saonn_paonn_streetn1'].str.strip().str.replace(",", "", regex=False)
-    
-    
-    # Create address variables from epc
-    # Rule 1-3, 7, 18
-    epc['add_1'] = epc['add'].str.strip()
-    epc['address_final1'] = epc['add_1'].str.replace(" ", "", regex=False)
-    # Rule 4-6, 8, 19, 22
-    epc['address_final2'] = epc['add_1'].str.replace("'", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace(".", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace("/", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace(" ", "", regex=False)
-    # Rule 9
-    epc['address_final3'] = epc['address_final2'].str.replace("-", "", regex=False)
-    # Rule 10-12, 16, 23
-    epc['add1__add2'] = epc['add1'].astype(str) + ", " + epc['add2'].astype(str)
-    epc['add1__add2'] = epc['add1__add2'].str.replace(" ", "", regex=False)
-    epc['address_final4'] = epc['add1__add2']
-    # Rule 13-15, 24
-    epc['address_final5'] = epc['address_final4'].str.replace("'", "", regex=False)
-    epc['address_final5'] = epc['address_final5'].str.replace(".", "", regex=False)
-    epc['address_final5'] = epc['address_final5'].str.replace("/", "", regex=False)
-    # Rule 17
-    epc['address_final6'] = epc['address_final5'].str.replace(",", "", regex=False)
+    ppd['saon_paon2'] = combine_fields([ppd['saon'], " ", ppd['paon']], delete=" ")
     # Rule 26
-    epc['address_final7'] = epc['address_final1'].str.replace(",", "", regex=False)
+    ppd['saon_paon1_street2'] = combine_fields([ppd['saon_paon1_street1']], strip=True, delete=",")
     # Rule 27
-    epc['address_final8'] = epc['address_final2'].str.replace(",", "", regex=False)
+    ppd['saonn_paonn_streetn2'] = combine_fields([ppd['saonn_paonn_streetn1']], strip=True, delete=",")
+    
     
-    link_keys, nLinks, new_unique_link_transactionids, ppd, epc = match_keys(ppd, epc, matching_rules, filter_requirements)
+    link_keys, nLinks, new_unique_link_address_ids = match_keys(ppd, epc, matching_rules, filter_requirements, matched, positions)
     
-    return link_keys, nLinks, new_unique_link_transactionids
+    return link_keys, nLinks, new_unique_link_address_ids
 
-def match_stage_2(ppd, epc):
+def match_stage_2(ppd, epc, matched=None):
     # NOTE: ppd records entering stage 2 are those with empty "saon"
-    # ppd: transactionid, postcode, saon, paon, street, locality
-    # epc: lmk_key, postcode, add, add1, add2
-    ppd = ppd[['transactionid', 'postcode', 'saon', 'paon', 'street', 'locality']]
-    epc = epc[['lmk_key', 'postcode', 'add', 'add1', 'add2']]  
+    # ppd: address_id, postcode, saon, paon, street, locality
+    # epc: feature store of the chunk epc records (lmk_key, postcode, add, add1, add2, add3, property_type)
+    # matched: shared mask of ppd records matched by earlier stages, updated in place
+    if matched is None:
+        matched = np.zeros(ppd.shape[0], dtype=bool)
     
     # Select ppd records with empty "saon"
-    ppd = ppd[ppd['saon'] == ""]
+    eligible = (ppd['saon'] == "").to_numpy(dtype=bool)
+    ppd, positions = select_unmatched(ppd, matched, ['address_id', 'postcode', 'saon', 'paon', 'street', 'locality'], eligible)
+    if ppd.empty: return empty_link_keys(), dict(), []
     
     # Define matching rules
     matching_rules = dict()
@@ -260,93 +480,44 @@ def match_stage_2(ppd, epc):
     
     
     # Create address variables from ppd
+    # Rule 29, 31, 33, 35, 38, 39
+    ppd['paonn'] = combine_fields([ppd['paon']], delete="'.")
+    ppd['streetn'] = combine_fields([ppd['street']], delete="'")
+    ppd['localityn'] = combine_fields([ppd['locality']], delete="'.")
     # Rule 28, 30
-    ppd['paon__street'] = ppd['paon'].astype(str) + ", " + ppd['street'].astype(str)
-    ppd['paon__street__locality'] = ppd['paon__street'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['paon__street__locality'] = ppd['paon__street__locality'].str.replace(" ", "", regex=False)
+    ppd['paon__street__locality'] = combine_fields([ppd['paon'], ", ", ppd['street'], ", ", ppd['locality']], delete=" ")
     # Rule 29, 31
-    ppd['paonn'] = ppd['paon'].str.replace("'", "", regex=False)
-    ppd['paonn'] = ppd['paonn'].str.replace(".", "", regex=False)
-    ppd['streetn'] = ppd['street'].str.replace("'", "", regex=False)
-    ppd['localityn'] = ppd['locality'].str.replace("'", "", regex=False)
-    ppd['localityn'] = ppd['localityn'].str.replace(".", "", regex=False)
-    ppd['paonn__streetn'] = ppd['paonn'].astype(str) + ", " + ppd['streetn'].astype(str)
-    ppd['paonn__streetn__localityn'] = ppd['paonn__streetn'].astype(str) + ", " + ppd['localityn'].astype(str)
-    ppd['paonn__streetn__localityn'] = ppd['paonn__streetn__localityn'].str.replace(" ", "", regex=False)
+    ppd['paonn__streetn__localityn'] = combine_fields([ppd['paonn'], ", ", ppd['streetn'], ", ", ppd['localityn']], delete=" ")
     # Rule 32, 34
-    ppd['paon_street'] = ppd['paon'].astype(str) + " " + ppd['street'].astype(str)
-    ppd['paon_street__locality'] = ppd['paon_street'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['paon_street__locality'] = ppd['paon_street__locality'].str.replace(" ", "", regex=False)
-    # Rule 33, 35
-    ppd['paonn_streetn'] = ppd['paonn'].astype(str) + ", " + ppd['streetn'].astype(str)
-    ppd['paonn_streetn__localityn'] = ppd['paonn_streetn'].astype(str) + ", " + ppd['localityn'].astype(str)
-    ppd['paonn_streetn__localityn'] = ppd['paonn_streetn__localityn'].str.replace(" ", "", regex=False)
+    ppd['paon_street__locality'] = combine_fields([ppd['paon'], " ", ppd['street'], ", ", ppd['locality']], delete=" ")
+    # Rule 33, 35 (same key as rule 29, 31)
+    ppd['paonn_streetn__localityn'] = ppd['paonn__streetn__localityn']
     # Rule 36, 37
-    ppd['paon_street_locality'] = ppd['paon_street'].astype(str) + " " + ppd['locality'].astype(str)
-    ppd['paon_street_locality'] = ppd['paon_street_locality'].str.replace(" ", "", regex=False)
-    ppd['paon_street_locality1'] = ppd['paon_street_locality'].str.replace(",", "", regex=False)
+    ppd['paon_street_locality1'] = combine_fields([ppd['paon'], " ", ppd['street'], " ", ppd['locality']], delete=" ,")
     # Rule 38
-    ppd['paonn__streetn1'] = ppd['paonn__streetn'].str.replace(" ", "", regex=False)
+    ppd['paonn__streetn1'] = combine_fields([ppd['paonn'], ", ", ppd['streetn']], delete=" ")
     # Rule 39
-    ppd['paonn1'] = ppd['paonn'].str.replace(" ", "", regex=False)
-    ppd['paonn2'] = ppd['paonn1'].str.replace("-", "", regex=False)
+    ppd['paonn2'] = combine_fields([ppd['paonn']], delete=" -")
     # Rule 40
-    ppd[['paon_comma_sep1', 'paon_comma_sep2']] = ppd['paon'].str.split(",", n=1, expand=True)
-    ppd['paon_comma_sep1__paon_comma_sep2'] = ppd['paon_comma_sep1'].astype(str) + ", " + ppd['paon_comma_sep2'].astype(str)
-    ppd['paon_comma_sep1__paon_comma_sep2'] = ppd['paon_comma_sep1__paon_comma_sep2'].str.replace(" ", "", regex=False)
-    
-    # Create address variables from epc
-    # Rule 28, 32
-    epc['add_1'] = epc['add'].str.strip()
-    epc['address_final1'] = epc['add_1'].str.replace(" ", "", regex=False)
-    # Rule 29, 33
-    epc['address_final2'] = epc['add_1'].str.replace("'", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace(".", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace("/", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace(" ", "", regex=False)
-    # Rule 
-    epc['address_final3'] = epc['address_final2'].str.replace("-", "", regex=False)
-    # Rule 30, 34
-    epc['add1__add2'] = epc['add1'].astype(str) + ", " + epc['add2'].astype(str)
-    epc['add1__add2'] = epc['add1__add2'].str.replace(" ", "", regex=False)
-    epc['address_final4'] = epc['add1__add2']
-    # Rule 31, 35
-    epc['address_final5'] = epc['address_final4'].str.replace("'", "", regex=False)
-    epc['address_final5'] = epc['address_final5'].str.replace(".", "", regex=False)
-    epc['address_final5'] = epc['address_final5'].str.replace("/", "", regex=False)
-    # Rule 
-    epc['address_final6'] = epc['address_final5'].str.replace(",", "", regex=False)
-    # Rule 37 
-    epc['address_final7'] = epc['address_final1'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['address_final8'] = epc['address_final2'].str.replace(",", "", regex=False)
-    # Rule 36
-    epc['address_final9'] = epc['address_final4'].str.replace(",", "", regex=False)
-    # Rule 38
-    epc['address_final10'] = epc['address_final5'].str.replace("-", "", regex=False)
-    # Rule 39, 40
-    epc['add1_1'] = epc['add1'].str.strip()
-    epc['add1_1'] = epc['add1_1'].str.replace(" ", "", regex=False)
-    epc['add1_2'] = epc['add1_1'].str.replace("'", "", regex=False)
-    epc['add1_2'] = epc['add1_2'].str.replace(".", "", regex=False)
-    epc['add1_2'] = epc['add1_2'].str.replace("/", "", regex=False)
-    epc['add1_2'] = epc['add1_2'].str.replace("-", "", regex=False)
-    epc['address_final11'] = epc['add1_2']
-    
+    ppd['paon_comma_sep1'], ppd['paon_comma_sep2'] = split_field(ppd['paon'], ",")
+    ppd['paon_comma_sep1__paon_comma_sep2'] = combine_fields([ppd['paon_comma_sep1'], ", ", ppd['paon_comma_sep2']], delete=" ")
     
-    link_keys, nLinks, new_unique_link_transactionids, ppd, epc = match_keys(ppd, epc, matching_rules, filter_requirements)
+    link_keys, nLinks, new_unique_link_address_ids = match_keys(ppd, epc, matching_rules, filter_requirements, matched, positions)
     
-    return link_keys, nLinks, new_unique_link_transactionids
+    return link_keys, nLinks, new_unique_link_address_ids
 
-def match_stage_3_not_flat(ppd, epc):
+def match_stage_3_not_flat(ppd, epc, matched=None):
     # NOTE: ppd records entering this stage are those with empty "saon" and non-F propertytype
-    # ppd: transactionid, postcode, saon, paon, street, locality
-    # epc: lmk_key, postcode, add, add1, add2
-    ppd = ppd[['transactionid', 'postcode', 'saon', 'paon', 'street', 'locality', 'propertytype']]
-    epc = epc[['lmk_key', 'postcode', 'add', 'add1', 'add2', 'add3', 'property_type']]
+    # ppd: address_id, postcode, saon, paon, street, locality
+    # epc: feature store of the chunk epc records (lmk_key, postcode, add, add1, add2, add3, property_type)
+    # matched: shared mask of ppd records matched by earlier stages, updated in place
+    if matched is None:
+        matched = np.zeros(ppd.shape[0], dtype=bool)
     
     # select the transaction which property type is not Flats/Maisonettes
-    ppd = ppd[(ppd['saon'] == "") & (ppd['propertytype'] != "F")]
+    eligible = ((ppd['saon'] == "") & (ppd['propertytype'] != "F")).to_numpy(dtype=bool)
+    ppd, positions = select_unmatched(ppd, matched, ['address_id', 'postcode', 'saon', 'paon', 'street', 'locality', 'propertytype'], eligible)
+    if ppd.empty: return empty_link_keys(), dict(), []
     
     # Define matching rules
     matching_rules = dict()
@@ -417,230 +588,42 @@ def match_stage_3_not_flat(ppd, epc):
     
     
     # Create address variables from ppd
+    # Rule 43
+    ppd['paonn'] = combine_fields([ppd['paon']], delete="'.")
+    ppd['streetn'] = combine_fields([ppd['street']], delete="'")
+    ppd['localityn'] = combine_fields([ppd['locality']], delete="'.")
+    # Rule 41-45, 49-51, 54-55, 57
+    ppd['paon_finalword'] = last_word(ppd['paon'])
+    ppd['paonn_finalword'] = last_word(ppd['paonn'])
+    ppd['paon_comma_sep1'], ppd['paon_comma_sep2'] = split_field(ppd['paon'], ",")
     # Rule 41, 42
-    ppd['paon_finalword'] = ppd['paon'].str.split(" ", n=-1, expand=False).str[-1]
-    ppd['paon_finalword__street'] = ppd['paon_finalword'].astype(str) + ", " + ppd['street'].astype(str)
-    ppd['paon_finalword__street__locality'] = ppd['paon_finalword__street'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['paon_finalword__street__locality'] = ppd['paon_finalword__street__locality'].str.replace(" ", "", regex=False)
+    ppd['paon_finalword__street__locality'] = combine_fields([ppd['paon_finalword'], ", ", ppd['street'], ", ", ppd['locality']], delete=" ")
     # Rule 43
-    ppd['saonn'] = ppd['saon'].str.replace("/", "", regex=False)
-    ppd['paonn'] = ppd['paon'].str.replace("'", "", regex=False)
-    ppd['paonn'] = ppd['paonn'].str.replace(".", "", regex=False)
-    ppd['streetn'] = ppd['street'].str.replace("'", "", regex=False)
-    ppd['localityn'] = ppd['locality'].str.replace("'", "", regex=False)
-    ppd['localityn'] = ppd['localityn'].str.replace(".", "", regex=False)
-    ppd['paonn_finalword'] = ppd['paonn'].str.split(" ", n=-1, expand=False).str[-1]
-    ppd['paonn_finalword__streetn'] = ppd['paonn_finalword'].astype(str) + ", " + ppd['streetn'].astype(str)
-    ppd['paonn_finalword__streetn__localityn'] = ppd['paonn_finalword__streetn'].astype(str) + ", " + ppd['localityn'].astype(str)
-    ppd['paonn_finalword__streetn__localityn'] = ppd['paonn_finalword__streetn__localityn'].str.replace(" ", "", regex=False)
+    ppd['paonn_finalword__streetn__localityn'] = combine_fields([ppd['paonn_finalword'], ", ", ppd['streetn'], ", ", ppd['localityn']], delete=" ")
     # Rule 44, 56
-    ppd['paon_finalword_street'] = ppd['paon_finalword'].astype(str) + " " + ppd['street'].astype(str)
-    ppd['paon_finalword_street_locality'] = ppd['paon_finalword_street'].astype(str) + " " + ppd['locality'].astype(str)
-    ppd['paon_finalword_street_locality'] = ppd['paon_finalword_street_locality'].str.replace(" ", "", regex=False)
-    ppd['paon_finalword_street_locality1'] = ppd['paon_finalword_street_locality'].str.replace(",", "", regex=False)
+    ppd['paon_finalword_street_locality1'] = combine_fields([ppd['paon_finalword'], " ", ppd['street'], " ", ppd['locality']], delete=" ,")
     # Rule 45
-    ppd[['paon_comma_sep1', 'paon_comma_sep2']] = ppd['paon'].str.split(",", n=1, expand=True)
-    ppd['paon_comma_sep1__street'] = ppd['paon_comma_sep1'].astype(str) + ", " + ppd['street'].astype(str)
-    ppd['paon_comma_sep1__street__locality'] = ppd['paon_comma_sep1__street'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['paon_comma_sep1__street__locality'] = ppd['paon_comma_sep1__street__locality'].str.replace(" ", "", regex=False)
+    ppd['paon_comma_sep1__street__locality'] = combine_fields([ppd['paon_comma_sep1'], ", ", ppd['street'], ", ", ppd['locality']], delete=" ")
     # Rule 46-48
-    ppd['paon_comma_sep1_street'] = ppd['paon_comma_sep1'].astype(str) + " " + ppd['street'].astype(str)
-    ppd['paon_comma_sep1_street_locality'] = ppd['paon_comma_sep1_street'].astype(str) + " " + ppd['locality'].astype(str)
-    ppd['paon_comma_sep1_street_locality'] = ppd['paon_comma_sep1_street_locality'].str.replace(" ", "", regex=False)
-    ppd['paon_comma_sep1_street_locality1'] = ppd['paon_comma_sep1_street_locality'].str.replace(",", "", regex=False)
+    ppd['paon_comma_sep1_street_locality1'] = combine_fields([ppd['paon_comma_sep1'], " ", ppd['street'], " ", ppd['locality']], delete=" ,")
     # Rule 49
-    ppd['paon_comma_sep1__locality'] = ppd['paon_comma_sep1'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['paon_comma_sep1__locality'] = ppd['paon_comma_sep1__locality'].str.replace(" ", "", regex=False)
+    ppd['paon_comma_sep1__locality'] = combine_fields([ppd['paon_comma_sep1'], ", ", ppd['locality']], delete=" ")
     # Rule 50, 51
-    ppd['paon_comma_sep1_street1'] = ppd['paon_comma_sep1_street'].str.replace(" ", "", regex=False)
-    ppd['paon_comma_sep1_street2'] = ppd['paon_comma_sep1_street1'].str.replace(",", "", regex=False)
+    ppd['paon_comma_sep1_street2'] = combine_fields([ppd['paon_comma_sep1'], " ", ppd['street']], delete=" ,")
     # Rule 52, 53
-    ppd['paon_finalword_street1'] = ppd['paon_finalword_street'].str.replace(" ", "", regex=False)
-    ppd['paon_finalword_street2'] = ppd['paon_finalword_street1'].str.replace(",", "", regex=False)
+    ppd['paon_finalword_street2'] = combine_fields([ppd['paon_finalword'], " ", ppd['street']], delete=" ,")
     # Rule 54, 55
-    ppd['paon_comma_sep1_paon_comma_sep2'] = ppd['paon_comma_sep1'].astype(str) + " " + ppd['paon_comma_sep2'].astype(str)
-    ppd['paon_comma_sep1_paon_comma_sep2_street'] = ppd['paon_comma_sep1_paon_comma_sep2'].astype(str) + " " + ppd['street'].astype(str)
-    ppd['paon_comma_sep1_paon_comma_sep2_street_locality'] = ppd['paon_comma_sep1_paon_comma_sep2_street'].astype(str) + " " + ppd['locality'].astype(str)
-    ppd['paon_comma_sep1_paon_comma_sep2_street_locality1'] = ppd['paon_comma_sep1_paon_comma_sep2_street_locality'].str.replace(" ", "", regex=False)
-    ppd['paon_comma_sep1_paon_comma_sep2_street_locality2'] = ppd['paon_comma_sep1_paon_comma_sep2_street_locality1'].str.replace(",", "", regex=False)
+    ppd['paon_comma_sep1_paon_comma_sep2_street_locality2'] = combine_fields([ppd['paon_comma_sep1'], " ", ppd['paon_comma_sep2'], " ", ppd['street'], " ", ppd['locality']], delete=" ,")
     # Rule 57
-    ppd['THE_paon_comma_sep1'] = "THE" + " " + ppd['paon_comma_sep1'].astype(str)
+    ppd['THE_paon_comma_sep1'] = combine_fields(["THE ", ppd['paon_comma_sep1']])
     # Rule 58-60, 63
-    ppd['paon__street'] = ppd['paon'].astype(str) + ", " + ppd['street'].astype(str)
-    ppd['paon__street__locality'] = ppd['paon__street'].astype(str) + ", " + ppd['locality'].astype(str)
-    ppd['paon__street__locality1'] = ppd['paon__street__locality'].str.replace(" ", "", regex=False)
-    ppd['paon__street__locality2'] = ppd['paon__street__locality1'].str.replace(",", "", regex=False)
+    ppd['paon__street__locality2'] = combine_fields([ppd['paon'], ", ", ppd['street'], ", ", ppd['locality']], delete=" ,")
     # Rule 61, 64, 65, 67
-    ppd['paon__street1'] = ppd['paon__street'].str.replace(" ", "", regex=False)
-    ppd['paon__street1'] = ppd['paon__street1'].str.replace(",", "", regex=False)
-    # Rule 66, 
-    ppd['streetn_1'] = ppd['street'].str.replace(".", "", regex=False)
-    ppd['streetn_1'] = ppd['streetn_1'].str.replace("'", "", regex=False)
-    ppd['streetn_1'] = ppd['streetn_1'].str.replace("-", "", regex=False)
-    ppd['paon__streetn_1'] = ppd['paon'].astype(str) + ", " + ppd['street'].astype(str)
-    ppd['paon__streetn_1'] = ppd['paon__streetn_1'].str.replace(" ", "", regex=False)
-    ppd['paon__streetn_1_1'] = ppd['paon__streetn_1'].str.replace(",", "", regex=False)
-    
-    
-    # Create address variables from epc
-    
-    
-    # Rule 41
-    epc['address_final1'] = epc['add'].str.replace(" ", "", regex=False)
-    # Rule 
-    epc['address_final2'] = epc['address_final1'].str.replace("'", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace(".", "", regex=False)
-    epc['address_final2'] = epc['address_final2'].str.replace("/", "", regex=False)
-    # Rule 43
-    epc['address_final3'] = epc['address_final2'].str.replace("-", "", regex=False)
-    # Rule 42
-    epc['add1__add2'] = epc['add1'].astype(str) + ", " + epc['add2'].astype(str)
-    epc['add1__add2_1'] = epc['add1__add2'].str.replace(" ", "", regex=False)
-    epc['address_final4'] = epc['add1__add2_1']
-    # Rule 
-    epc['address_final5'] = epc['address_final4'].str.replace("'", "", regex=False)
-    epc['address_final5'] = epc['address_final5'].str.replace(".", "", regex=False)
-    epc['address_final5'] = epc['address_final5'].str.replace("/", "", regex=False)
-    # Rule 48
-    epc['address_final6'] = epc['address_final5'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['address_final7'] = epc['address_final1'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['address_final8'] = epc['address_final2'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['address_final9'] = epc['address_final4'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['address_final10'] = epc['address_final5'].str.replace("-", "", regex=False)
-    # Rule 
-    epc['add1_1'] = epc['add1'].str.strip()
-    epc['add1_1'] = epc['add1_1'].str.replace(" ", "", regex=False)
-    epc['add1_2'] = epc['add1_1'].str.replace("'", "", regex=False)
-    epc['add1_2'] = epc['add1_2'].str.replace(".", "", regex=False)
-    epc['add1_2'] = epc['add1_2'].str.replace("/", "", regex=False)
-    epc['add1_3'] = epc['add1_2'].str.replace("-", "", regex=False)
-    epc['add1_4'] = epc['add1_2'].str.replace(",", "", regex=False)
-    # Rule 66
-    epc['add1_5'] = epc['add1_1'].str.replace(",", "", regex=False)
-    epc['address_final11'] = epc['add1_2']
-    # Rule
-    epc['add_1'] = epc['add'].str.strip()
-    epc['address_final12'] = epc['add_1'].str.replace(" ", "", regex=False)
-    # Rule 46
-    epc['address_final13'] = epc['address_final12'].str.replace(",", "", regex=False)
-    # Rule 45
-    epc['address_final14'] = epc['address_final12'].str.replace("'", "", regex=False)
-    epc['address_final14'] = epc['address_final14'].str.replace(".", "", regex=False)
-    epc['address_final14'] = epc['address_final14'].str.replace("/", "", regex=False)
-    # Rule 47
-    epc['address_final15'] = epc['address_final14'].str.replace(",", "", regex=False)
-    # Rule 49
-    epc['add1__add2_2'] = epc['add1__add2'].str.strip()
-    epc['add1__add2_2'] = epc['add1__add2_2'].str.replace(" ", "", regex=False)
-    epc['address_final16'] = epc['add1__add2_2'].str.replace("'", "", regex=False)
-    epc['address_final16'] = epc['address_final16'].str.replace(".", "", regex=False)
-    epc['address_final16'] = epc['address_final16'].str.replace("/", "", regex=False)
-    # Rule 50
-    epc['address_final17'] = epc['address_final16'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['add1__add3'] = epc['add1'].astype(str) + ", " + epc['add3'].astype(str)
-    epc['add1__add3_1'] = epc['add1__add3'].str.replace(" ", "", regex=False)
-    epc['add1__add3_2'] = epc['add1__add3'].str.strip()
-    epc['add1__add3_2'] = epc['add1__add3_2'].str.replace(" ", "", regex=False)
-    # Rule
-    epc['address_final18'] = epc['add1__add3_2'].str.replace("'", "", regex=False)
-    epc['address_final18'] = epc['address_final18'].str.replace(".", "", regex=False)
-    epc['address_final18'] = epc['address_final18'].str.replace("/", "", regex=False)
-    # Rule 51
-    epc['address_final19'] = epc['address_final18'].str.replace(",", "", regex=False)
-    # Rule 54
-    epc['address_final20'] = epc['address_final3'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['add1_add2'] = epc['add1'].astype(str) + " " + epc['add2'].astype(str)
-    epc['add1_add2_1'] = epc['add1_add2'].str.replace(" ", "", regex=False)
-    epc['add1_add2_2'] = epc['add1_add2'].str.strip()
-    epc['add1_add2_2'] = epc['add1_add2_2'].str.replace(" ", "", regex=False)
-    # Rule 
-    epc['address_final21'] = epc['add1_add2_2'].str.replace(",", "", regex=False)
-    # Rule
-    epc['address_final22'] = epc['add1_add2_2'].str.replace("'", "", regex=False)
-    epc['address_final22'] = epc['address_final22'].str.replace(".", "", regex=False)
-    epc['address_final22'] = epc['address_final22'].str.replace("/", "", regex=False)
-    # Rule 55
-    epc['address_final23'] = epc['address_final22'].str.replace(",", "", regex=False)
-    # Rule
-    epc['address_final24'] = epc['address_final23'].str.replace("-", "", regex=False)
-    # Rule 
-    epc['add2_add3'] = epc['add2'].astype(str) + " " + epc['add3'].astype(str)
-    epc['add2_add3_1'] = epc['add2_add3'].str.replace(" ", "", regex=False)
-    epc['add2_add3_2'] = epc['add2_add3'].str.strip()
-    epc['add2_add3_2'] = epc['add2_add3_2'].str.replace(" ", "", regex=False)
-    # Rule 
-    epc['address_final25'] = epc['add2_add3_2'].str.replace(",", "", regex=False)
-    # Rule
-    epc['address_final26'] = epc['add2_add3_2'].str.replace("'", "", regex=False)
-    epc['address_final26'] = epc['address_final26'].str.replace(".", "", regex=False)
-    epc['address_final26'] = epc['address_final26'].str.replace("/", "", regex=False)
-    # Rule 56
-    epc['address_final27'] = epc['address_final26'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['address_final28'] = epc['address_final27'].str.replace("-", "", regex=False)
-    # Rule 58
-    epc['add2_1'] = epc['add2'].str.replace("-", "", regex=False)
-    epc['add1_add2_1'] = epc['add1'].astype(str) + " " + epc['add2_1'].astype(str)
-    epc['address_final29'] = epc['add1_add2_1'].str.replace(" ", "", regex=False)
-    epc['address_final29'] = epc['address_final29'].str.replace("'", "", regex=False)
-    epc['address_final29'] = epc['address_final29'].str.replace(".", "", regex=False)
-    epc['address_final29'] = epc['address_final29'].str.replace("/", "", regex=False)
-    epc['address_final29'] = epc['address_final29'].str.replace(",", "", regex=False)
-    # Rule 
-    epc['add1_add3'] = epc['add1'].astype(str) + " " + epc['add3'].astype(str)
-    epc['add1_add3_1'] = epc['add1_add3'].str.replace(" ", "", regex=False)
-    epc['add1_add3_2'] = epc['add1_add3'].str.strip()
-    epc['add1_add3_2'] = epc['add1_add3_2'].str.replace(" ", "", regex=False)
-    # Rule
-    epc['address_final30'] = epc['add1_add3_2'].str.replace("'", "", regex=False)
-    epc['address_final30'] = epc['address_final30'].str.replace(".", "", regex=False)
-    epc['address_final30'] = epc['address_final30'].str.replace("/", "", regex=False)
-    # Rule 
-    epc['address_final31'] = epc['add1_add3_2'].str.replace(",", "", regex=False)
-    # Rule 59
-    epc['address_final32'] = epc['address_final30'].str.replace(",", "", regex=False)
-    # Rule 60
-    epc['address_final33'] = epc['add1_add3_1'].str.replace(",", "", regex=False)
-    # Rule 63
-    epc[['add1_comma_sep1', 'add1_comma_sep2']] = epc['add1'].str.split(",", n=1, expand=True)
-    epc['add1_comma_sep2_1'] = epc['add1_comma_sep2'].str.replace("-", "", regex=False)
-    epc['add1_comma_sep1__add1_comma_sep2_1'] = epc['add1_comma_sep1'].astype(str) + ", " + epc['add1_comma_sep2_1'].astype(str)
-    epc['add1_comma_sep1__add1_comma_sep2_1__add2'] = epc['add1_comma_sep1__add1_comma_sep2_1'].astype(str) + ", " + epc['add2'].astype(str)
-    epc['address_final34'] = epc['add1_comma_sep1__add1_comma_sep2_1__add2'].str.replace(" ", "", regex=False)
-    epc['address_final35'] = epc['address_final34'].str.replace(",", "", regex=False)
-    # Rule 64
-    epc['add1_comma_sep2_2'] = epc['add1_comma_sep2'].str.replace(".", "", regex=False)
-    epc['add1_comma_sep1__add1_comma_sep2_2'] = epc['add1_comma_sep1'].astype(str) + ", " + epc['add1_comma_sep2_2'].astype(str)
-    epc['address_final36'] = epc['add1_comma_sep1__add1_comma_sep2_2'].str.replace(" ", "", regex=False)
-    epc['address_final37'] = epc['address_final36'].str.replace(",", "", regex=False)
-    # Rule 65
-    epc['add1_firstword'] = epc['add1'].str.split(" ", n=1, expand=False).str[0]
-    epc['add1_firstword__add2'] = epc['add1_firstword'].astype(str) + ", " + epc['add2'].astype(str)
-    # Rule 67
-    epc['address_final38'] = epc['address_final13'].str.replace("UNIT ", "", regex=False)
-    
-    link_keys, nLinks, new_unique_link_transactionids, ppd, epc = match_keys(ppd, epc, matching_rules, filter_requirements)
-    
-    return link_keys, nLinks, new_unique_link_transactionids
-
-def match_stage_3_flat(ppd, epc):
-    # NOTE
-    # ppd: transactionid, postcode, saon, paon, street, locality
-    # epc: lmk_key, postcode, add, add1, add2
-    # select the transaction which property type is Flats/Maisonettes
-    ppd = ppd[ppd['propertytype'] == "F"]
-
-    
-    
-
-def match_stage_4(ppd, epc):
-    # ppd records entering stage 2 are those with empty "saon"
-    # ppd: 
-    # epc:
-    pass
\ No newline at end of file
+    ppd['paon__street1'] = combine_fields([ppd['paon'], ", ", ppd['street']], delete=" ,")
+    # Rule 66 (same key as rule 61, as it has always been built from the raw street)
+    ppd['paon__streetn_1_1'] = ppd['paon__street1']
+    
+    
+    link_keys, nLinks, new_unique_link_address_ids = match_keys(ppd, epc, matching_rules, filter_requirements, matched, positions)
+    
+    return link_keys, nLinks, new_unique_link_address_ids
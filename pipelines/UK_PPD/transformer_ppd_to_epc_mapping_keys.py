@@ -5,25 +5,136 @@ from .config import *
 from libraries import db_functions as db_func
 from libraries import helper_transformation_functions as helper_transform
 from . import link_functions as link_func
+from . import dirty_postcode_functions as dirty_func
 
 # Import py libs
 import pandas as pd
+import numpy as np
 import logging
-from sqlalchemy.engine import Engine
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from typing import Iterator
+from sqlalchemy import text
+from sqlalchemy.engine import Engine, Connection
 
 
 # Define global variables
 OUTPUT_TABLE_NAME = "pricepaid_to_residential_epc"
 PIPELINE_INPUT_PPD = INPUT_DATA["DB"]["price_paid"]
-PIPELINE_INPUT_EPC = INPUT_DATA["DB"]["residential_energy_performance_certificate"]
+PIPELINE_INPUT_EPC = INPUT_DATA["DB"]["residential_epc_linkage_keys"]
 PIPELINE_OUTPUT = OUTPUT_DATA["DB"][OUTPUT_TABLE_NAME]
 
 
-def ETL_ppd_to_rre_epc_update_by_year(mydb: Engine, year: int):
+def link_postcode_chunk(ppd: pd.DataFrame, epc: pd.DataFrame) -> pd.DataFrame:
+    # Runs in the worker processes in parallel mode: only link keys are sent back
+    
+    # Drop duplicates if exists
+    epc.drop_duplicates(inplace=True)
+    
+    if 'address' in epc.columns:
+        # Normalize raw epc address fields
+        epc = helper_transform.standardardize_nan(epc, NAN_PATTERNS, standard="")
+        epc = epc.fillna("")
+        epc = link_func.normalize_address_variables(epc)
+        epc = epc[['lmk_key', 'postcode', 'add', 'add1', 'add2', 'add3', 'property_type']]
+    
+    # Derived epc address variables are computed on first use and shared by all stages,
+    # precomputed epc linkage keys are used as they are
+    epc_features = link_func.epc_feature_store(epc)
+    del epc
+
+    # Link each distinct ppd address once
+    addresses, address_ids = link_func.dedupe_addresses(ppd)
+    logging.info(f"Linking {addresses.shape[0]} distinct addresses of {ppd.shape[0]} transactions...")
+
+    # Shared mask of addresses already matched, updated in place by every rule and stage
+    matched = np.zeros(addresses.shape[0], dtype=bool)
+    
+    # STAGE 1 DONE
+    logging.info("STAGE 1 linking...")
+    link_keys_stage_1, nLinks, new_unique_link_address_ids = link_func.match_stage_1(addresses, epc_features, matched)
+    
+    # STAGE 2 DONE
+    logging.info("STAGE 2 linking...")
+    link_keys_stage_2, nLinks, new_unique_link_address_ids = link_func.match_stage_2(addresses, epc_features, matched)
+    
+    # STAGE 3 ONGOING
+    logging.info("STAGE 3 linking...")
+    link_keys_stage_3, nLinks, new_unique_link_address_ids = link_func.match_stage_3_not_flat(addresses, epc_features, matched)
+    
+    # Fan address link keys out to transactions
+    address_mapping_keys = pd.concat([link_keys_stage_1, link_keys_stage_2, link_keys_stage_3], ignore_index=True)
+    epc_mapping_keys = link_func.expand_to_transactions(address_mapping_keys, ppd, address_ids)
+    
+    return epc_mapping_keys
+
+def link_postcode_chunks(postcode_chunks: Iterator[tuple[pd.DataFrame, pd.DataFrame]], max_workers: int=1) -> Iterator[pd.DataFrame]:
+    if max_workers <= 1:
+        for ppd, epc in postcode_chunks:
+            yield link_postcode_chunk(ppd, epc)
+        return
+    
+    # Bound the number of chunks held in memory by pending tasks
+    max_chunks_in_flight = max_workers * LINKAGE_MAX_CHUNKS_IN_FLIGHT_PER_WORKER
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for ppd, epc in postcode_chunks:
+            pending.add(executor.submit(link_postcode_chunk, ppd, epc))
+            
+            if len(pending) >= max_chunks_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        
+        for future in as_completed(pending):
+            yield future.result()
+
+def stream_epc_blocks(conn: Connection, postcodes_table: str) -> Iterator[pd.DataFrame]:
+    # Blocks of epc records ordered by postcode, the records of a postcode are never split across blocks
+    epc_query = f"""SELECT {', '.join(f"E.{column}" for column in PIPELINE_INPUT_EPC['needed_columns'])}
+                    FROM {PIPELINE_INPUT_EPC['db_schema']}.{PIPELINE_INPUT_EPC['table_name']} E
+                        INNER JOIN {postcodes_table} P ON E.postcode = P.postcode
+                    ORDER BY E.postcode;"""
+    
+    epc_carried = None
+    for epc in db_func.stream_sql_query(epc_query, conn, chunksize=LINKAGE_EPC_BLOCK_ROWS):
+        # An empty result comes as a single empty frame
+        if epc.empty: continue
+        if epc_carried is not None:
+            epc = pd.concat([epc_carried, epc], ignore_index=True)
+        
+        # Carry the last postcode over, its records may continue in the next rows
+        is_last_postcode = (epc['postcode'] == epc['postcode'].iat[-1]).values
+        epc_carried = epc[is_last_postcode]
+        if not is_last_postcode.all():
+            yield epc[~is_last_postcode]
+    
+    if epc_carried is not None:
+        yield epc_carried
+
+def extract_postcode_chunks(mydb: Engine, year_ppd: pd.DataFrame) -> Iterator[tuple[pd.DataFrame, pd.DataFrame]]:
+    # Positions of the ppd records of each postcode
+    ppd_positions = year_ppd.groupby('postcode', sort=False).indices
+    
+    with mydb.connect() as conn:
+        # Extract: Upload the ppd postcodes and stream the epc data with matching postcode in one query
+        db_func.copy_values_to_temp_table(list(ppd_positions.keys()), "linkage_postcodes", "postcode", conn)
+        
+        for epc in stream_epc_blocks(conn, "linkage_postcodes"):
+            ppd_chunk = year_ppd.iloc[np.concatenate([ppd_positions[postcode] for postcode in epc['postcode'].unique()])]
+            logging.info(f"A block of EPC data has been extracted from DB with {epc.shape[0]} records for linking.")
+            
+            yield ppd_chunk, epc
+
+def ETL_ppd_to_rre_epc_update_by_year(mydb: Engine, year: int, to_year: int=None, max_workers: int=1):
+    
+    # Several years can be linked in one run so that repeat sales share their address linkage
+    if to_year is None:
+        to_year = year
     
     # Extract: Get price paid data of year
     year_ppd_query = f"""SELECT {', '.join(PIPELINE_INPUT_PPD['needed_columns'])} FROM {PIPELINE_INPUT_PPD['db_schema']}.{PIPELINE_INPUT_PPD['table_name']}
-                        WHERE EXTRACT(year FROM "dateoftransfer") = {year}::numeric;"""
+                        WHERE EXTRACT(year FROM "dateoftransfer") BETWEEN {year}::numeric AND {to_year}::numeric;"""
 
     year_ppd = pd.read_sql(year_ppd_query, mydb)
     # Normalize epc address fields
@@ -31,88 +142,60 @@ def ETL_ppd_to_rre_epc_update_by_year(mydb: Engine, year: int):
     year_ppd = year_ppd.fillna("")
     logging.info(f"PPD data has been extracted from DB with {year_ppd.shape[0]} records.")
 
-    # Get unique postcode in ppd data
-    year_ppd_unique_postcodes = year_ppd['postcode'].unique()
-
-    # Loop through postcode in chunks of 1000
-    chunksize = 5000
-    year_ppd_unique_postcodes_chunks = [year_ppd_unique_postcodes[i * chunksize:(i + 1) * chunksize] for i in range((len(year_ppd_unique_postcodes) + chunksize - 1) // chunksize )]
-
-    for postcode_chunk in year_ppd_unique_postcodes_chunks:
-        postcode_chunk = postcode_chunk.tolist()
-        postcode_chunk = ['' if j is None else j for j in postcode_chunk]
-
-        # Extract: Get epc data of year with matching postcode
-        epc_query = f"""SELECT {', '.join(PIPELINE_INPUT_EPC['needed_columns'])} FROM {PIPELINE_INPUT_EPC['db_schema']}.{PIPELINE_INPUT_EPC['table_name']}
-                            WHERE postcode IN {tuple(postcode_chunk)};"""
-
-        ppd_epc_mapping_keys = pd.DataFrame(columns=list(PIPELINE_OUTPUT["column_types"].keys()))
+    # Link postcode chunks, in parallel if more than one worker
+    ppd_epc_mapping_keys = pd.DataFrame(columns=list(PIPELINE_OUTPUT["column_types"].keys()))
+    postcode_chunks = extract_postcode_chunks(mydb, year_ppd)
+    epc_mapping_keys = list(link_postcode_chunks(postcode_chunks, max_workers=max_workers))
+    
+    # Union all link keys
+    ppd_epc_mapping_keys = pd.concat([ppd_epc_mapping_keys] + epc_mapping_keys, ignore_index=True)
+    ppd_epc_mapping_keys.drop_duplicates(inplace=True)
+    ppd_epc_mapping_keys = ppd_epc_mapping_keys.astype(PIPELINE_OUTPUT["column_types"])
 
-        # Extract: Get epc data with matching postcode
-        epc = pd.read_sql(epc_query, mydb)
+    # Load: Replace the link rows of the years' transactions in one transaction, links no longer found are removed
+    delete_query = f"""DELETE FROM {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T1
+                       USING       {PIPELINE_INPUT_PPD["db_schema"]}.{PIPELINE_INPUT_PPD["table_name"]} T2
+                       WHERE  T1.transactionid = T2.transactionid
+                           AND  EXTRACT(year FROM T2."dateoftransfer") BETWEEN {year}::numeric AND {to_year}::numeric;"""
+    with mydb.begin() as conn:
+        conn.execute(text(delete_query))
+        db_func.copy_to_table(ppd_epc_mapping_keys, PIPELINE_OUTPUT["table_name"], PIPELINE_OUTPUT["db_schema"], PIPELINE_OUTPUT["column_types"], conn,
+                              conflict_columns=PIPELINE_OUTPUT["unique_columns"], update=False)
 
-        if epc.empty: continue
-        logging.info(f"A chunk of EPC data has been extracted from DB with {epc.shape[0]} records for linking.")
-        
-        # Drop duplicates if exists
-        epc.drop_duplicates(inplace=True)
-        
-        # Normalize epc address fields
-        epc = helper_transform.standardardize_nan(epc, NAN_PATTERNS, standard="")
-        epc = epc.fillna("")
-        epc = link_func.normalize_address_variables(epc)
+    if ppd_epc_mapping_keys.empty:
+        logging.info(f"No links found for {year}-{to_year}!")
+    else:
+        logging.info(f"Processing done for {year}-{to_year} with {ppd_epc_mapping_keys.shape[0]} records.")
 
-        # Initialize dataframe for chunked epc link keys
-        epc_mapping_keys = pd.DataFrame(columns=list(PIPELINE_OUTPUT["column_types"].keys()))
-        
-        # STAGE 1 DONE
-        logging.info("STAGE 1 linking...")
-        year_ppd = year_ppd[~year_ppd['transactionid'].isin(list(epc_mapping_keys['transactionid']))]
-        link_keys, nLinks, new_unique_link_transactionids = link_func.match_stage_1(year_ppd, epc)
-        link_keys = link_keys[['transactionid', 'lmk_key']]
-        epc_mapping_keys = pd.concat([epc_mapping_keys, link_keys], ignore_index=True)
-        epc_mapping_keys.drop_duplicates(inplace=True)
+def extract_dirty_postcode_chunks(mydb: Engine, dirty_postcodes: list) -> Iterator[tuple[pd.DataFrame, pd.DataFrame]]:
+    chunksize = LINKAGE_POSTCODE_CHUNKSIZE
+    
+    for i in range(0, len(dirty_postcodes), chunksize):
+        postcode_chunk = dirty_postcodes[i:i + chunksize]
         
-        # STAGE 2 DONE
-        logging.info("STAGE 2 linking...")
-        year_ppd = year_ppd[~year_ppd['transactionid'].isin(list(epc_mapping_keys['transactionid']))]
-        link_keys, nLinks, new_unique_link_transactionids = link_func.match_stage_2(year_ppd, epc)
-        link_keys = link_keys[['transactionid', 'lmk_key']]
-        epc_mapping_keys = pd.concat([epc_mapping_keys, link_keys], ignore_index=True)
-        epc_mapping_keys.drop_duplicates(inplace=True)
+        # Extract: Get all price paid data and epc data with matching postcode
+        ppd_query = f"""SELECT {', '.join(PIPELINE_INPUT_PPD['needed_columns'])} FROM {PIPELINE_INPUT_PPD['db_schema']}.{PIPELINE_INPUT_PPD['table_name']}
+                        WHERE postcode = ANY(:postcodes);"""
+        ppd = pd.read_sql(text(ppd_query), mydb, params={'postcodes': postcode_chunk})
+        ppd = helper_transform.standardardize_nan(ppd, NAN_PATTERNS, standard="")
+        ppd = ppd.fillna("")
         
-        # STAGE 3 ONGOING
-        logging.info("STAGE 3 linking...")
-        year_ppd = year_ppd[~year_ppd['transactionid'].isin(list(epc_mapping_keys['transactionid']))]
-        link_keys, nLinks, new_unique_link_transactionids = link_func.match_stage_3_not_flat(year_ppd, epc)
-        link_keys = link_keys[['transactionid', 'lmk_key']]
-        epc_mapping_keys = pd.concat([epc_mapping_keys, link_keys], ignore_index=True)
-        epc_mapping_keys.drop_duplicates(inplace=True)
-
-        # STAGE 4
-        # TODO
+        epc_query = f"""SELECT {', '.join(PIPELINE_INPUT_EPC['needed_columns'])} FROM {PIPELINE_INPUT_EPC['db_schema']}.{PIPELINE_INPUT_EPC['table_name']}
+                        WHERE postcode = ANY(:postcodes);"""
+        epc = pd.read_sql(text(epc_query), mydb, params={'postcodes': postcode_chunk})
         
-        # Union all link keys
-        ppd_epc_mapping_keys = pd.concat([ppd_epc_mapping_keys, epc_mapping_keys], ignore_index=True)
-        ppd_epc_mapping_keys.drop_duplicates(inplace=True)
+        if ppd.empty or epc.empty: continue
+        logging.info(f"A chunk of dirty postcodes has been extracted from DB with {ppd.shape[0]} PPD and {epc.shape[0]} EPC records for linking.")
         
-    ppd_epc_mapping_keys = ppd_epc_mapping_keys.astype(PIPELINE_OUTPUT["column_types"])
-
-    # Load: Load dataframe as parquet file to S3
-    if ppd_epc_mapping_keys.empty:
-        logging.info("No new data to load to s3!")
-        return None
-    else:
-        # Load: Load to database
-        ppd_epc_mapping_keys.to_sql(PIPELINE_OUTPUT["table_name"], con= mydb, schema=PIPELINE_OUTPUT["db_schema"], if_exists='append', index=False)
-        logging.info(f"Processing done for {year} with {ppd_epc_mapping_keys.shape[0]} records.")
-
+        yield ppd, epc
 
 # Pipeline's main functions
-def ETL_ppd_epc_mapping_keys(from_year: int=None, to_year: int=None):
+def ETL_ppd_epc_mapping_keys(from_year: int=None, to_year: int=None, max_workers: int=LINKAGE_MAX_WORKERS, years_per_run: int=LINKAGE_YEARS_PER_RUN):
 
     # Connect to db
     mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_pricepaid_to_residential_epc.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_linkage_dirty_postcodes.sql", mydb)
 
     # Get current date
     current_date, current_month, current_year = helper_transform.get_current_datetime()
@@ -128,26 +211,63 @@ def ETL_ppd_epc_mapping_keys(from_year: int=None, to_year: int=None):
 
     from_year = int(from_year)
     to_year = int(to_year)
+    max_workers = int(max_workers)
+    years_per_run = int(years_per_run)
 
     # Check invalid year input
     if from_year > to_year or to_year > current_year or from_year < PPD_MIN_YEAR:
         raise ValueError(f"Invalid year input! Price paid data is available from {PPD_MIN_YEAR} to {current_month}-{current_year}.")
     
     logging.info(f"Started processing for available transactions of {from_year}-{to_year}.")
+    marked_until = pd.Timestamp.now()
     
-    for year in range(from_year, to_year+1):
-        ETL_ppd_to_rre_epc_update_by_year(mydb, year)
-        logging.info(f"""Update done for {year}.""")
+    for year in range(from_year, to_year+1, years_per_run):
+        run_to_year = min(year + years_per_run - 1, to_year)
+        ETL_ppd_to_rre_epc_update_by_year(mydb, year, to_year=run_to_year, max_workers=max_workers)
+        logging.info(f"""Update done for {year}-{run_to_year}.""")
 
-    # Drop duplicates from from database
-    drop_duplicates_query = f"""DELETE FROM {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T1
-                                USING       {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T2
-                                WHERE  T1.ctid < T2.ctid       -- delete the "older" ones
-                                    AND  T1.transactionid    = T2.transactionid
-                                    AND  T1.lmk_key          = T2.lmk_key;       -- list columns that define duplicates
-                            """
-    db_func.execute_sql_query(drop_duplicates_query, mydb)
+    # Postcodes marked before the run and fully relinked are left out of the next incremental run
+    with mydb.begin() as conn:
+        dirty_func.clear_relinked_postcodes(from_year, to_year, marked_until, conn)
+
+    db_func.disconnect_db(mydb)
 
+def ETL_ppd_epc_mapping_keys_incremental(max_workers: int=LINKAGE_MAX_WORKERS):
+    # Relink only the postcodes touched by the extractors since the last run
+    max_workers = int(max_workers)
+    
+    # Connect to db
+    mydb = db_func.connect_to_db(DB_URL)
+    db_func.execute_sql_from_file("sql/create_table_pricepaid_to_residential_epc.sql", mydb)
+    db_func.execute_sql_from_file("sql/create_table_linkage_dirty_postcodes.sql", mydb)
+    
+    marked_until = pd.Timestamp.now()
+    dirty_postcodes = dirty_func.get_dirty_postcodes(mydb, marked_until)
+    logging.info(f"Started relinking {len(dirty_postcodes)} dirty postcodes.")
+    
+    if dirty_postcodes:
+        # Link postcode chunks, in parallel if more than one worker
+        ppd_epc_mapping_keys = pd.DataFrame(columns=list(PIPELINE_OUTPUT["column_types"].keys()))
+        postcode_chunks = extract_dirty_postcode_chunks(mydb, dirty_postcodes)
+        epc_mapping_keys = list(link_postcode_chunks(postcode_chunks, max_workers=max_workers))
+        
+        ppd_epc_mapping_keys = pd.concat([ppd_epc_mapping_keys] + epc_mapping_keys, ignore_index=True)
+        ppd_epc_mapping_keys.drop_duplicates(inplace=True)
+        ppd_epc_mapping_keys = ppd_epc_mapping_keys.astype(PIPELINE_OUTPUT["column_types"])
+        
+        # Load: Replace the link rows of the dirty postcodes in one transaction
+        delete_query = f"""DELETE FROM {PIPELINE_OUTPUT["db_schema"]}.{PIPELINE_OUTPUT["table_name"]} T1
+                           USING       {PIPELINE_INPUT_PPD["db_schema"]}.{PIPELINE_INPUT_PPD["table_name"]} T2
+                           WHERE  T1.transactionid = T2.transactionid
+                               AND  T2.postcode = ANY(:postcodes);"""
+        with mydb.begin() as conn:
+            conn.execute(text(delete_query), {'postcodes': dirty_postcodes})
+            db_func.copy_to_table(ppd_epc_mapping_keys, PIPELINE_OUTPUT["table_name"], PIPELINE_OUTPUT["db_schema"], PIPELINE_OUTPUT["column_types"], conn,
+                                  conflict_columns=PIPELINE_OUTPUT["unique_columns"], update=False)
+            dirty_func.clear_dirty_postcodes(dirty_postcodes, marked_until, conn)
+        
+        logging.info(f"Relinking done for {len(dirty_postcodes)} postcodes with {ppd_epc_mapping_keys.shape[0]} records.")
+    
     db_func.disconnect_db(mydb)
 
     
@@ -155,7 +275,10 @@ def main(*args):
     logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S %Z')
     
-    ETL_ppd_epc_mapping_keys(*args)
+    if args and args[0] == "incremental":
+        ETL_ppd_epc_mapping_keys_incremental(*args[1:])
+    else:
+        ETL_ppd_epc_mapping_keys(*args)
     
 
 if __name__ == "__main__":
@@ -9,27 +9,39 @@ DB_URL = str(os.getenv("DB_URL"))
 
 
 # RUNTIME CONFIGURATIONS
-COLUMN_TYPES = {"unique_property_reference_number": {"uprn": "string",
-                                                     "x_coordinate": "string",
-                                                     "y_coordinate": "string",
-                                                     "latitude": "string",
-                                                     "longitude": "string"
+
+# Source files are downloaded only when changed since the last loaded download recorded in the manifest
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")
+DOWNLOAD_MANIFEST_PATH = os.getenv("DOWNLOAD_MANIFEST_PATH", os.path.join(DOWNLOAD_DIR, "manifest.json"))
+
+# Raw pulls are persisted as parquet partitioned by source, year and month when enabled, to be replayed without network
+LANDING_ZONE = {"path": os.getenv("LANDING_ZONE_PATH", "landing"),
+                "enabled": os.getenv("LANDING_ZONE_ENABLED", "false").lower() == "true",
+                "compression": "zstd"}
+
+COLUMN_TYPES = {"unique_property_reference_number": {"uprn": "Int64",
+                                                     "x_coordinate": float,
+                                                     "y_coordinate": float,
+                                                     "latitude": float,
+                                                     "longitude": float
                                                      }
                 }
 
 NAN_PATTERNS = ["N/A", "NaN", "nan", "unknown", "UNKNOWN", "Unknown", "INVALID!", "NODATA!", "NO DATA!", ""]
 
-# OUTPUT_DATA -> connection -> output_table_name -> bucket, country, subject, source, table_name, path_date_params, file_extension, column_types
+# OUTPUT_DATA -> connection -> output_table_name -> bucket, country, subject, source, table_name, path_date_params, file_extension, column_types, unique_columns
 OUTPUT_DATA =  {"DB": {"unique_property_reference_number": {"table_name": "unique_property_reference_number",
                                                             "db_schema": "linked_ppd_epc",
-                                                            "column_types": COLUMN_TYPES["unique_property_reference_number"]
+                                                            "column_types": COLUMN_TYPES["unique_property_reference_number"],
+                                                            "unique_columns": ["uprn"]
                                                             }
                             }
                 }
 
 # INPUT_DATA -> connection -> output_table_name -> platform-specific configs
-INPUT_DATA = {"SOURCE": {"unique_property_reference_number": {"endpoint_url": "https://api.os.uk/downloads/v1/products/OpenUPRN/downloads\?area\=GB\&format\=CSV\&redirect",
-                                                              "save_to_path": "uprn.zip"
+INPUT_DATA = {"SOURCE": {"unique_property_reference_number": {"endpoint_url": "https://api.os.uk/downloads/v1/products/OpenUPRN/downloads?area=GB&format=CSV&redirect",
+                                                              "save_to_path": "uprn.zip",
+                                                              "chunksize": 1000000
                                                               }
                         }
               }
\ No newline at end of file
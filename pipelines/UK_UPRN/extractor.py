@@ -4,49 +4,86 @@ from .config import *
 # Import custom modules
 from libraries import db_functions as db_func
 from libraries import helper_transformation_functions as helper_transform
+from libraries import http_functions as http_func
+from libraries import landing_functions as landing_func
 
 # Import py libs
 import pandas as pd
-import numpy as np
+import requests
 import logging
 import zipfile
 from datetime import datetime
 import os
+from itertools import chain
+from typing import Iterator, Iterable
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
 
 
 # Define global variables
 OUTPUT_TABLE_NAME = "unique_property_reference_number"
 PIPELINE_INPUT = INPUT_DATA["SOURCE"][OUTPUT_TABLE_NAME]
 PIPELINE_OUTPUT = OUTPUT_DATA["DB"][OUTPUT_TABLE_NAME]
+LANDING_SOURCE = "uprn"
 
 # Define helper functions
 def normalize_raw_uprn(uprn: pd.DataFrame):
     # Standardize column names
     uprn.columns = list(PIPELINE_OUTPUT["column_types"].keys())
     
-    # Standardize nan
-    uprn = helper_transform.standardardize_nan(uprn, NAN_PATTERNS, standard=np.nan)
-    uprn = uprn.fillna(np.nan)
-    
-    # Assign dtype
-    uprn = uprn.astype(PIPELINE_OUTPUT["column_types"])
-    uprn = helper_transform.standardardize_nan(uprn, NAN_PATTERNS, standard=np.nan)
+    # Assign dtype, a no-op for chunks read typed with nan patterns parsed as nan
+    uprn = uprn.astype(PIPELINE_OUTPUT["column_types"], copy=False)
     
     # Drop duplicates
     uprn.drop_duplicates(inplace=True)
     
     return uprn
 
+def stream_uprn_chunks(file_path: str, uprn_file_name: str, update_year: int, update_month: int,
+                       chunksize: int=PIPELINE_INPUT['chunksize']) -> Iterator[pd.DataFrame]:
+    # Read the zip member chunk by chunk as typed columns, so that memory is bounded by the chunk size.
+    # Raw chunks are landed one part each when enabled
+    if LANDING_ZONE["enabled"]:
+        landing_func.clear_partition(LANDING_ZONE["path"], LANDING_SOURCE, update_year, update_month)
+
+    with zipfile.ZipFile(file_path) as z:
+        with z.open(uprn_file_name) as f:
+            chunks = pd.read_csv(f, header=0, names=list(PIPELINE_OUTPUT["column_types"].keys()), dtype=PIPELINE_OUTPUT["column_types"],
+                                 na_values=NAN_PATTERNS, keep_default_na=False, chunksize=chunksize)
+            for part, uprn in enumerate(chunks):
+                if LANDING_ZONE["enabled"]:
+                    landing_func.write_partition(uprn, LANDING_ZONE["path"], LANDING_SOURCE, update_year, update_month, part=part, compression=LANDING_ZONE["compression"])
+
+                # Transform: Normalization
+                yield normalize_raw_uprn(uprn)
+
+def load_uprn(uprn: Iterable[pd.DataFrame], mydb: Engine) -> int:
+    # Replace the table in one transaction. Chunks go through a staging table, uprns already loaded
+    # from an earlier chunk are skipped against the unique index
+    with mydb.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {PIPELINE_OUTPUT['db_schema']}.{PIPELINE_OUTPUT['table_name']};"))
+        with open("sql/create_table_unique_property_reference_number.sql") as f:
+            conn.execute(text(f.read()))
+
+        return db_func.copy_to_table(uprn, PIPELINE_OUTPUT["table_name"], PIPELINE_OUTPUT["db_schema"], PIPELINE_OUTPUT["column_types"], conn,
+                                     conflict_columns=PIPELINE_OUTPUT["unique_columns"], update=False)
+
 # Pipeline's main functions
 def ETL_uprn_full():
 
     # Extract: API requests
     url = PIPELINE_INPUT['endpoint_url']
-    file_path = PIPELINE_INPUT['save_to_path']
-    status = os.system(f"wget {url} -O {file_path}")
-    success = True
+    file_path = os.path.join(DOWNLOAD_DIR, PIPELINE_INPUT['save_to_path'])
+    try:
+        download = http_func.download_if_changed(url, file_path, DOWNLOAD_MANIFEST_PATH)
+        success = True
+    except requests.RequestException as e:
+        logging.error(e)
+        success = False
 
-    uprn = pd.DataFrame()
+    if success and download is None:
+        logging.info("UPRN data unchanged since the last update. No data to be load!")
+        return None
 
     if success:
         logging.info(f"Downloading from URL {url} succeeded.")
@@ -63,38 +100,68 @@ def ETL_uprn_full():
                 update_year = update_date_datetime.year
                 update_month = update_date_datetime.month
                 logging.info(f"Newest data was updated on: {update_year}-{update_month:02d}")
-
-                with z.open(uprn_file_name) as f:
-                    logging.info(f"Extracting newest data released on {update_year}-{update_month:02d}")
-                    uprn = pd.read_csv(f)
             except IndexError:
                 logging.error("No file name matches \"osopenuprn\"")
-        
-        if uprn.empty:
+                return None
+
+        logging.info(f"Extracting newest data released on {update_year}-{update_month:02d}")
+        current_date, current_month, current_year = helper_transform.get_current_datetime()
+
+        # Extract & Transform: Chunks are read and normalized as they are loaded, the table is kept if there is none
+        uprn = stream_uprn_chunks(file_path, uprn_file_name, update_year, update_month)
+        first_chunk = next(uprn, None)
+        if first_chunk is None:
             logging.warning("No data extracted from the zip file. No data to be load!")
             return None
-        else:
-            # Transform: Normalization
-            uprn = normalize_raw_uprn(uprn)
-
-            # Load: Load to database
-            current_date, current_month, current_year = helper_transform.get_current_datetime()
-            
-            ### Connect to db
-            mydb = db_func.connect_to_db(DB_URL)
-            uprn.to_sql(PIPELINE_OUTPUT["table_name"], con= mydb, schema=PIPELINE_OUTPUT["db_schema"], if_exists='replace', index=False, chunksize=5000)
-            logging.info(f"Processing done on {current_date} for the newest UPRN data released on  {update_month}-{update_year}.")
+
+        # Load: Replace the table in one transaction
+        mydb = db_func.connect_to_db(DB_URL)
+        nRows = load_uprn(chain([first_chunk], uprn), mydb)
+        db_func.disconnect_db(mydb)
+
+        http_func.record_download(url, download, DOWNLOAD_MANIFEST_PATH)
+        logging.info(f"Processing done on {current_date} for the newest UPRN data released on  {update_month}-{update_year} with {nRows} records.")
         
         os.remove(file_path)
     else:
         logging.error(f"Downloading from URL {url} failed")
 
+def ETL_uprn_replay(year: int=None, month: int=None):
+    # Normalize and load again a landed release, the newest one by default, no download is made
+    partitions = landing_func.get_partitions(LANDING_ZONE["path"], LANDING_SOURCE)
+    if year is not None and month is not None:
+        partitions = [partition for partition in partitions if partition == (int(year), int(month))]
+
+    if not partitions:
+        logging.warning(f"No landed data in {LANDING_ZONE['path']}. No data to be load!")
+        return None
+
+    update_year, update_month = partitions[-1]
+    logging.info(f"Replaying UPRN data released on {update_year}-{update_month:02d}")
+
+    # Extract, Transform & Load: Landed parts are normalized and loaded one by one, the table is replaced in one transaction
+    uprn = (normalize_raw_uprn(uprn) for uprn in landing_func.read_partition(LANDING_ZONE["path"], LANDING_SOURCE, update_year, update_month))
+
+    mydb = db_func.connect_to_db(DB_URL)
+    nRows = load_uprn(uprn, mydb)
+    db_func.disconnect_db(mydb)
+    logging.info(f"Replay done for the UPRN data released on {update_month}-{update_year} with {nRows} records.")
+
+def ETL_uprn(mode: str="full", *args):
+
+    if mode == "full":
+        ETL_uprn_full()
+    elif mode == "replay":
+        ETL_uprn_replay(*args)
+    else:
+        raise ValueError(f"Invalid mode input! Only 'full' and 'replay' are allowed.")
+
 
-def main():
+def main(*args):
     logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S %Z')
     
-    ETL_uprn_full()
+    ETL_uprn(*args)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,12 @@
+-- This file is for the postcodes to relink, recorded by the ppd and epc extractors
+
+
+-- Create table
+CREATE TABLE IF NOT EXISTS linked_ppd_epc.linkage_dirty_postcodes
+(
+  postcode text,
+  source text,
+  marked_at timestamp
+);
+
+CREATE INDEX IF NOT EXISTS linkage_dirty_postcodes_postcode_idx ON linked_ppd_epc.linkage_dirty_postcodes (postcode);
@@ -29,4 +29,19 @@ CREATE TABLE IF NOT EXISTS linked_ppd_epc.price_paid
 -- 3.1/ Clean transactions which are not sold at full market value
 -- DELETE FROM  pricepaid WHERE categorytype='B';
 -- 3.2/ Clean transactions for which the property type is 'Other'
--- DELETE FROM  pricepaid WHERE propertytype='O';
\ No newline at end of file
+-- DELETE FROM  pricepaid WHERE propertytype='O';
+
+-- Linkage reads transactions by postcode
+CREATE INDEX IF NOT EXISTS price_paid_postcode_idx ON linked_ppd_epc.price_paid (postcode);
+
+-- Loads upsert on the transaction key, duplicates left by older loads are deleted once before the unique index is built
+DO $$
+BEGIN
+  IF to_regclass('linked_ppd_epc.price_paid_transactionid_key') IS NULL THEN
+    DELETE FROM linked_ppd_epc.price_paid T1
+    USING       linked_ppd_epc.price_paid T2
+    WHERE       T1.ctid < T2.ctid
+            AND T1.transactionid = T2.transactionid;
+    CREATE UNIQUE INDEX price_paid_transactionid_key ON linked_ppd_epc.price_paid (transactionid);
+  END IF;
+END $$;
@@ -0,0 +1,12 @@
+-- This file is for the transactions added, changed or deleted by the ppd monthly updates, for downstream reprocessing
+
+
+-- Create table
+CREATE TABLE IF NOT EXISTS linked_ppd_epc.price_paid_changes
+(
+  transactionid text,
+  recordstatus text,
+  changed_at timestamp
+);
+
+CREATE INDEX IF NOT EXISTS price_paid_changes_transactionid_idx ON linked_ppd_epc.price_paid_changes (transactionid);
@@ -5,10 +5,18 @@ CREATE TABLE IF NOT EXISTS linked_ppd_epc.pricepaid_to_residential_epc
   lmk_key text NOT NULL
 );
 
--- Delete duplicates
-DELETE FROM linked_ppd_epc.pricepaid_to_residential_epc T1
-USING 		linked_ppd_epc.pricepaid_to_residential_epc T2
-WHERE 		T1.ctid < T2.ctid
-		AND T1.transactionid = T2.transactionid
-		AND T1.lmk_key = T2.lmk_key
-;
\ No newline at end of file
+-- Incremental linkage replaces the link rows of transactions
+CREATE INDEX IF NOT EXISTS pricepaid_to_residential_epc_transactionid_idx ON linked_ppd_epc.pricepaid_to_residential_epc (transactionid);
+
+-- Loads insert new links only, duplicates left by older loads are deleted once before the unique index is built
+DO $$
+BEGIN
+  IF to_regclass('linked_ppd_epc.pricepaid_to_residential_epc_transactionid_lmk_key_key') IS NULL THEN
+    DELETE FROM linked_ppd_epc.pricepaid_to_residential_epc T1
+    USING       linked_ppd_epc.pricepaid_to_residential_epc T2
+    WHERE       T1.ctid < T2.ctid
+            AND T1.transactionid = T2.transactionid
+            AND T1.lmk_key = T2.lmk_key;
+    CREATE UNIQUE INDEX pricepaid_to_residential_epc_transactionid_lmk_key_key ON linked_ppd_epc.pricepaid_to_residential_epc (transactionid, lmk_key);
+  END IF;
+END $$;
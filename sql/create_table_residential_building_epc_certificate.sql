@@ -93,6 +93,6 @@ CREATE TABLE IF NOT EXISTS linked_ppd_epc.residential_building_epc_certificate
   TENURE text, -- rented, owner...
   FIXED_LIGHTING_OUTLETS_COUNT float,
   LOW_ENERGY_FIXED_LIGHT_COUNT float,
-  UPRN text, --100110786110
+  UPRN bigint, --100110786110
   UPRN_SOURCE text
 );
\ No newline at end of file
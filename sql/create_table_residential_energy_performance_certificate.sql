@@ -0,0 +1,111 @@
+-- This file is for the domestic energy performance certificates
+
+
+-- Create table
+CREATE TABLE IF NOT EXISTS linked_ppd_epc.residential_energy_performance_certificate
+(
+  lmk_key text NOT NULL,
+  address1 text,
+  address2 text,
+  address3 text,
+  postcode text,
+  building_reference_number text,
+  current_energy_rating text,
+  potential_energy_rating text,
+  current_energy_efficiency double precision,
+  potential_energy_efficiency double precision,
+  property_type text,
+  built_form text,
+  inspection_date timestamp,
+  local_authority text,
+  constituency text,
+  county text,
+  lodgement_date timestamp,
+  transaction_type text,
+  environment_impact_current double precision,
+  environment_impact_potential double precision,
+  energy_consumption_current double precision,
+  energy_consumption_potential double precision,
+  co2_emissions_current double precision,
+  co2_emiss_curr_per_floor_area double precision,
+  co2_emissions_potential double precision,
+  lighting_cost_current double precision,
+  lighting_cost_potential double precision,
+  heating_cost_current double precision,
+  heating_cost_potential double precision,
+  hot_water_cost_current double precision,
+  hot_water_cost_potential double precision,
+  total_floor_area double precision,
+  energy_tariff text,
+  mains_gas_flag text,
+  floor_level text,
+  flat_top_storey text,
+  flat_storey_count double precision,
+  main_heating_controls double precision,
+  multi_glaze_proportion double precision,
+  glazed_type text,
+  glazed_area text,
+  extension_count double precision,
+  number_habitable_rooms double precision,
+  number_heated_rooms double precision,
+  low_energy_lighting double precision,
+  number_open_fireplaces double precision,
+  hotwater_description text,
+  hot_water_energy_eff text,
+  hot_water_env_eff text,
+  floor_description text,
+  floor_energy_eff text,
+  floor_env_eff text,
+  windows_description text,
+  windows_energy_eff text,
+  windows_env_eff text,
+  walls_description text,
+  walls_energy_eff text,
+  walls_env_eff text,
+  secondheat_description text,
+  sheating_energy_eff text,
+  sheating_env_eff text,
+  roof_description text,
+  roof_energy_eff text,
+  roof_env_eff text,
+  mainheat_description text,
+  mainheat_energy_eff text,
+  mainheat_env_eff text,
+  mainheatcont_description text,
+  mainheatc_energy_eff text,
+  mainheatc_env_eff text,
+  lighting_description text,
+  lighting_energy_eff text,
+  lighting_env_eff text,
+  main_fuel text,
+  wind_turbine_count double precision,
+  heat_loss_corridor text,
+  unheated_corridor_length double precision,
+  floor_height double precision,
+  photo_supply double precision,
+  solar_water_heating_flag text,
+  mechanical_ventilation text,
+  address text,
+  local_authority_label text,
+  constituency_label text,
+  posttown text,
+  construction_age_band text,
+  lodgement_datetime timestamp,
+  tenure text,
+  fixed_lighting_outlets_count double precision,
+  low_energy_fixed_light_count double precision,
+  uprn bigint,
+  uprn_source text
+);
+
+-- Loads upsert on the certificate key, duplicates left by older loads are deleted once before the unique index is built
+DO $$
+BEGIN
+  IF to_regclass('linked_ppd_epc.residential_energy_performance_certificate_lmk_key_key') IS NULL THEN
+    DELETE FROM linked_ppd_epc.residential_energy_performance_certificate T1
+    USING       linked_ppd_epc.residential_energy_performance_certificate T2
+    WHERE       T1.ctid < T2.ctid
+            AND T1.lmk_key = T2.lmk_key;
+    CREATE UNIQUE INDEX residential_energy_performance_certificate_lmk_key_key ON linked_ppd_epc.residential_energy_performance_certificate (lmk_key);
+  END IF;
+END $$;
@@ -0,0 +1,57 @@
+-- This file is for the normalized epc address keys used by the linkage rules
+
+
+-- Create table
+CREATE TABLE IF NOT EXISTS linked_ppd_epc.residential_epc_linkage_keys
+(
+  lmk_key text NOT NULL,
+  postcode text,
+  add1 text,
+  add2 text,
+  property_type text,
+  address_final1 text,
+  address_final2 text,
+  address_final3 text,
+  address_final4 text,
+  address_final5 text,
+  address_final6 text,
+  address_final7 text,
+  address_final8 text,
+  address_final9 text,
+  address_final10 text,
+  address_final11 text,
+  address_final13 text,
+  address_final14 text,
+  address_final15 text,
+  address_final16 text,
+  address_final17 text,
+  address_final19 text,
+  address_final20 text,
+  address_final24 text,
+  address_final27 text,
+  address_final29 text,
+  address_final32 text,
+  address_final33 text,
+  address_final35 text,
+  address_final37 text,
+  address_final38 text,
+  add1_4 text,
+  add1_5 text,
+  add1_comma_sep2_1 text,
+  add1_firstword__add2 text
+);
+
+-- Linkage reads the keys by postcode
+CREATE INDEX IF NOT EXISTS residential_epc_linkage_keys_postcode_idx ON linked_ppd_epc.residential_epc_linkage_keys (postcode);
+
+-- Loads upsert on the certificate key, duplicates left by older loads are deleted once before the unique index is built
+DO $$
+BEGIN
+  IF to_regclass('linked_ppd_epc.residential_epc_linkage_keys_lmk_key_key') IS NULL THEN
+    DELETE FROM linked_ppd_epc.residential_epc_linkage_keys T1
+    USING       linked_ppd_epc.residential_epc_linkage_keys T2
+    WHERE       T1.ctid < T2.ctid
+            AND T1.lmk_key = T2.lmk_key;
+    CREATE UNIQUE INDEX residential_epc_linkage_keys_lmk_key_key ON linked_ppd_epc.residential_epc_linkage_keys (lmk_key);
+  END IF;
+END $$;
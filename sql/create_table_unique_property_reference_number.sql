@@ -1,11 +1,14 @@
 CREATE TABLE IF NOT EXISTS linked_ppd_epc.unique_property_reference_number(
-uprn text,
-x_coordinate string,
-y_coordinate string,
-latitude string,
-longitude string
+uprn bigint,
+x_coordinate double precision,
+y_coordinate double precision,
+latitude double precision,
+longitude double precision
 );
 
+-- Create index: the loader skips uprns already loaded from an earlier chunk
+CREATE UNIQUE INDEX IF NOT EXISTS unique_property_reference_number_uprn_key ON linked_ppd_epc.unique_property_reference_number (uprn);
+
 -- https://postcoder.com/docs/address-lookup/addressbase-uprn
 -- https://osdatahub.os.uk/downloads/open/OpenUPRN
 -- COPY linked_ppd_epc.open_uprn FROM '../data/osopenuprn_202301_csv/osopenuprn_202211.csv' DELIMITERS ',' CSV HEADER;
\ No newline at end of file